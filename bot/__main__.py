@@ -12,8 +12,10 @@ from discord.ext import commands
 
 import bot.utils.logger as logger
 import bot.utils.events as events
-from bot.utils.extensions import load_cog, calculate_lines
-from bot.utils.models import Guild
+from bot.utils.extensions import KatCog, load_cog, calculate_lines
+from bot.utils.models import Guild, guild_cache
+from bot.utils.message_context import MessageContextCache
+from bot.utils.dispatch import MessageDispatcher
 from bot.utils import constants
 from bot.utils.api import APIClient
 
@@ -45,6 +47,10 @@ class Kat(commands.Bot):
 
         # New API
         self.session = APIClient()
+        # Lookups shared between every listener handling the same message.
+        self.message_contexts = MessageContextCache()
+        # Routes messages to the cogs' message handlers.
+        self.dispatcher = MessageDispatcher(self.log)
 
         self.app_info = None  # gets populated by self.application_info() in on_ready()
         self.id = -1  # quick access to bot's id, populated on_ready()
@@ -91,6 +97,36 @@ class Kat(commands.Bot):
             self.dispatch("maintenance_mode", False)
             self.is_restart_scheduled = 0
 
+    async def close(self):
+        """Let cogs flush pending state, then close the API session and disconnect."""
+        for cog in list(self.cogs.values()):
+            if isinstance(cog, KatCog):
+                try:
+                    await cog.cog_shutdown()
+                except Exception as e:
+                    self.log.exception(
+                        "Failed to shutdown cog: {}".format(cog.qualified_name),
+                        exc_info=e,
+                    )
+        await self.session.close()
+        await super().close()
+
+    def add_cog(self, cog):
+        super().add_cog(cog)
+        self.dispatcher.add_cog(cog)
+
+    def remove_cog(self, name):
+        cog = self.get_cog(name)
+        if cog is not None:
+            self.dispatcher.remove_cog(cog)
+        super().remove_cog(name)
+
+    async def on_message(self, message):
+        """Route the message to interested cog handlers, then process any command in it."""
+        context = self.message_context(message)
+        self.dispatcher.dispatch(message, context.is_home_guild)
+        await self.process_commands(message)
+
     async def on_error(self, event, *args, **kwargs):
         """Event called when an event raises an exception"""
         self.log.exception("Ignoring exception ", exc_info=sys.exc_info()[2])
@@ -137,6 +173,7 @@ class Kat(commands.Bot):
         self.id = self.app_info.id
         self.log.info(f"Kat is connected to {len(self.guilds)} guilds")
         self.guild_count = len(self.guilds)
+        self.loop.create_task(self.prefetch_guilds([guild.id for guild in self.guilds]))
         self.setup_events()
         self.load_start_cogs()
 
@@ -160,6 +197,29 @@ class Kat(commands.Bot):
         # for guild in self.guilds:
         #     self.sql.ensure_exists("KatGuild", guild_id=guild.id)
 
+    async def on_guild_join(self, guild):
+        await self.prefetch_guilds([guild.id])
+
+    async def on_guild_remove(self, guild):
+        guild_cache.invalidate(guild.id)
+
+    async def prefetch_guilds(self, ids):
+        """Warm the guild settings cache so first messages don't wait on the API."""
+        start = time.time()
+        # Serve whatever we persisted last run straight away, then refresh it from the API.
+        seeded = Guild.warm_start(ids, self.session)
+        if seeded:
+            self.log.info("Warm started settings for {} guilds".format(seeded))
+        with self.session.background():
+            fetched, failed = await Guild.prefetch(
+                ids, self.session, constants.ApiCache.prefetch_concurrency, refresh=bool(seeded)
+            )
+        self.log.info(
+            "Prefetched settings for {} guilds in {} seconds ({} failed)".format(
+                fetched, format(time.time() - start, ".2f"), failed
+            )
+        )
+
     def setup_events(self):
         if not self.is_first_boot:
             self.log.debug("Not first boot. Skipping event creation.")
@@ -174,11 +234,19 @@ class Kat(commands.Bot):
         self.event_manager.create_events(_event_map)
         self.log.info("Events intialized.")
 
+    def message_context(self, message):
+        """Return the `MessageContext` shared by every listener handling `message`."""
+        return self.message_contexts.get(self, message)
+
     async def get_custom_prefix(self, bot, message):
         """Callable, returns the prefix for the message's guild."""
-        prefix = (await Guild.get(message.guild.id, self.session)).ensure_setting(
-            constants.GuildSettings.prefix, constants.Bot.def_prefix
-        )
+        guild = await self.message_context(message).guild()
+        if guild is None:
+            prefix = constants.Bot.def_prefix
+        else:
+            prefix = guild.ensure_setting(
+                constants.GuildSettings.prefix, constants.Bot.def_prefix
+            )
         return commands.when_mentioned_or(*prefix)(bot, message)
 
     def load_settings(self):
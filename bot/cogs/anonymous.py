@@ -1,9 +1,9 @@
 from datetime import datetime
 
-from discord.ext import commands
 import discord
 
 from bot.utils.extensions import KatCog
+from bot.utils.dispatch import message_handler
 
 
 class Anonymous(KatCog):
@@ -12,21 +12,20 @@ class Anonymous(KatCog):
         self.rant_channel = None
         self.hidden = True
 
-    @commands.Cog.listener()
+    @message_handler(dm_only=True, prefix="RANT ")
     async def on_message(self, message):
-        guild = discord.utils.get(self.bot.guilds, id=311612862554439692)
+        guild = self.bot.message_context(message).get_guild(311612862554439692)
 
-        if (type(message.channel) is discord.channel.DMChannel and message.author in guild.members and message.author != self.bot.user):
-            if message.content.startswith("RANT "):
+        if guild is not None and guild.get_member(message.author.id) is not None:
 
-                # Kat Dev Server, testing-ground-1
+            # Kat Dev Server, testing-ground-1
 
-                self.rant_channel = discord.utils.get(guild.channels, id=432214639305162752)
+            self.rant_channel = guild.get_channel(432214639305162752)
 
-                embed = discord.Embed(colour=discord.Colour(0xcec0ce), description=message.clean_content)
-                self.log.info(f"[RANT] Sent a rant. {message.author.id}")
-                await self.rant_channel.send(embed=embed)
+            embed = discord.Embed(colour=discord.Colour(0xcec0ce), description=message.clean_content)
+            self.log.info(f"[RANT] Sent a rant. {message.author.id}")
+            await self.rant_channel.send(embed=embed)
 
-                await message.channel.send("Your rant has been successfully sent!\n\nThis message will delete after 60 seconds. You can safely remove your rant.\n\n*This command is completely anonymous, if people abuse this it will be removed!*", delete_after=60)
+            await message.channel.send("Your rant has been successfully sent!\n\nThis message will delete after 60 seconds. You can safely remove your rant.\n\n*This command is completely anonymous, if people abuse this it will be removed!*", delete_after=60)
 def setup(bot):
     bot.add_cog(Anonymous(bot))
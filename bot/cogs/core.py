@@ -8,6 +8,8 @@ from discord.ext import commands
 
 from bot.utils.extensions import KatCog
 from bot.utils import constants
+from bot.utils.models import guild_cache
+import bot.utils.events as events
 import bot.utils.extensions as extensions
 import bot.utils.metrics as metrics
 import bot.utils.permissions as perms
@@ -35,9 +37,62 @@ class Core(KatCog):
             "Mem Usage": metrics.get_sys_mem_usage(),
             "Kat Mem Usage": metrics.get_proc_mem_usage(),
             "Loaded Cogs": ", ".join(self.bot.cogs.keys()),
+            "Guild Cache": "{size} guilds, {hits} hits / {misses} misses "
+            "({hit_rate:.1%}), {evictions} evictions".format(**guild_cache.stats()),
+            "API Requests": self.api_metrics(),
+            "Message Handlers": self.handler_metrics(),
+            "Slow Events": self.event_metrics(),
             "Last exec_output": self.output,
         }
 
+    def api_metrics(self, top=5):
+        """Summary of the busiest Kat API routes."""
+        lines = [
+            "{} x{} err {} mean {:.0f}ms p95 {:.0f}ms".format(
+                route, s["requests"], s["errors"], s["mean_ms"], s["p95_ms"]
+            )
+            for route, s in self.bot.session.get_stats(top).items()
+        ]
+        if not lines:
+            return "No requests yet"
+
+        queued = ", ".join(
+            f"{priority} {waiting}"
+            for priority, waiting in self.bot.session.get_queue_depths().items()
+        )
+        lines.append(
+            "queued: {} | 304 not modified: {}".format(
+                queued or "none", self.bot.session.not_modified
+            )
+        )
+        return "\n".join(lines)
+
+    def handler_metrics(self, top=5):
+        """Summary of the message handlers taking the most time."""
+        lines = [
+            "{} x{} err {} mean {:.1f}ms max {:.0f}ms".format(
+                name, s["requests"], s["errors"], s["mean_ms"], s["max_ms"]
+            )
+            for name, s in self.bot.dispatcher.get_stats(top).items()
+        ]
+        return "\n".join(lines) or "No handlers registered"
+
+    def event_metrics(self, top=5):
+        """Summary of the slowest periodic event handlers."""
+        lines = [
+            "{} x{} err {} mean {:.0f}ms max {:.0f}ms overruns {} ({})".format(
+                name,
+                s["requests"],
+                s["errors"],
+                s["mean_ms"],
+                s["max_ms"],
+                s["overruns"],
+                s["policy"],
+            )
+            for name, s in events.event_stats(self.bot.loop, top).items()
+        ]
+        return "\n".join(lines) or "No events run yet"
+
     def checksum_generation(self):
         self.log.info("Generating checksums...")
         self.checksums = metrics.generate_checksums(
@@ -1,14 +1,14 @@
 import random
 import datetime
 import re
-import os
 import time
 
 import discord
 import requests
 from discord.ext import commands
 
-from bot.utils.extensions import KatCog, write_resource
+from bot.utils.extensions import KatCog
+from bot.utils.dispatch import message_handler
 from bot.utils import constants
 
 
@@ -27,6 +27,8 @@ class Fun(KatCog):
         ]
 
         self.bot.run_day_check = True
+        # Persisted, so a Megumonday missed whilst we were down is still announced once.
+        self.event_manager.create_event("megumonday", constants.Fun.megumonday, persist=True)
 
     def _get_and_cache_gifs(self, search_query):
         """Download gif cache and store results for 1 hour."""
@@ -99,43 +101,30 @@ class Fun(KatCog):
         return embed
 
     @commands.Cog.listener()
-    async def on_kat_hour_event(self):
+    async def on_kat_megumonday(self):
         if not self.bot.run_day_check:
             return
 
         try:
-            guild = discord.utils.get(self.bot.guilds, id=constants.HomeGuild.ids[0])
-            channel = discord.utils.get(guild.channels, id=constants.HomeGuild.channels[0])
+            guild = self.bot.get_guild(constants.HomeGuild.ids[0])
+            channel = guild.get_channel(constants.HomeGuild.channels[0])
         except AttributeError:
             # we mustn't be able to see Reign guild
             self.bot.run_day_check = False
             return
 
-        self.log.info("Daily check started.")
-        date = datetime.datetime.today()
-
-        if date.weekday():  # is monday
-            if "megu_done" not in os.listdir("bot/resources/days/"):
-                if channel != None:
-                    await channel.send(
-                        self.dayresponse[0], file=discord.File("bot/resources/days/0.png")
-                    )
-
-                    write_resource("days/megu_done", "1")
-                    self.log.info("It's megumonday!")
-        else:
-            try:
-                os.remove("bot/resources/days/megu_done")
-            except FileNotFoundError:
-                pass
+        if channel is not None:
+            await channel.send(
+                self.dayresponse[0], file=discord.File("bot/resources/days/0.png")
+            )
+            self.log.info("It's megumonday!")
 
-    @commands.Cog.listener()
+    @message_handler(home_guild_only=True, pattern=r"(?i)gorl")
     async def on_message(self, ctx):
-        if "gorl" in ctx.content.lower() and ctx.guild.id in constants.HomeGuild.ids:
-            emoji = discord.utils.get(
-                self.bot.get_guild(311612862554439692).emojis, name="gorl"
-            )
-            await ctx.add_reaction(emoji)
+        emoji = discord.utils.get(
+            self.bot.message_context(ctx).get_guild(311612862554439692).emojis, name="gorl"
+        )
+        await ctx.add_reaction(emoji)
 
     @commands.command()
     async def time(self, ctx):
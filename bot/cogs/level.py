@@ -1,12 +1,22 @@
-import math
+import time
 
 from discord.ext import commands
 import discord
 
 
 from bot.utils.extensions import KatCog
-from bot.utils.models import Member, Guild
-from bot.utils import constants
+from bot.utils.dispatch import message_handler
+from bot.utils.api import Priority
+from bot.utils.models import Guild, guild_cache
+from bot.utils.cogs.level import (
+    Leaderboard,
+    RankIndex,
+    XPBuffer,
+    XPCooldown,
+    compile_prefixes,
+    recalculate_levels,
+)
+from bot.utils import constants, level_curve
 import bot.utils.permissions as permissions
 
 
@@ -17,10 +27,8 @@ class Level(KatCog):
         # This announcement attaches itself to $level and $leaderboard.
         # Use this to announce things todo with levels.
         self.announcement = ""
-        self.ignore_chars = constants.Level.ignore_chars
-
-        self.level_boundaries = {}
-        self.generate_level_boundaries(1000)
+        # Messages starting with any of these never earn XP, guilds can add their own.
+        self.ignore_prefixes = compile_prefixes(constants.Level.ignore_chars)
 
         # Instance variables
         self.global_freeze = (
@@ -29,65 +37,131 @@ class Level(KatCog):
 
         self.debug_mode = True  # Extra verbosity when user's gain xp.
 
-    @commands.Cog.listener()
+        # Limits how often a member can earn XP, checked before touching the API.
+        self.xp_cooldown = XPCooldown(
+            per=constants.Level.xp_cooldown_per, burst=constants.Level.xp_cooldown_burst
+        )
+
+        # XP is accumulated in memory and written back to the API in batches.
+        self.xp_buffer = XPBuffer(
+            self.bot.session,
+            flush_size=constants.Level.xp_flush_size,
+            bulk_endpoint=constants.Level.xp_bulk_endpoint,
+            concurrency=constants.Level.xp_flush_concurrency,
+            retry_delay=constants.Level.xp_flush_interval,
+        )
+        # Flush started early because the buffer filled up, at most one at a time.
+        self._flush_task = None
+        self.event_manager.create_event(
+            "level_xp_flush", constants.Level.xp_flush_interval
+        )
+
+        # Top members per guild, kept up to date as XP is awarded.
+        self.leaderboards = Leaderboard(
+            self.bot.session,
+            size=constants.Level.leaderboard_size,
+            refresh_interval=constants.Level.leaderboard_refresh,
+            buffer=self.xp_buffer,
+        )
+        # Every member's XP per guild, for $level's rank.
+        self.ranks = RankIndex(
+            self.bot.session,
+            refresh_interval=constants.Level.leaderboard_refresh,
+            max_guilds=constants.Level.rank_index_guilds,
+            buffer=self.xp_buffer,
+        )
+
+    @message_handler(guild_only=True)
     async def on_message(self, msg):
-        """Discord event. Fired every time a message is recieved from a guild. """
-        if not msg.author.bot and not self.global_freeze:
-            if not await self.check_guild_freeze_status(msg.guild.id):
-                # If the message does not start with characters in settings.ignore_chars
-                for chars in self.ignore_chars:
-                    if msg.content.startswith(chars):
-                        return
-
-                await self.give_xp(msg)
-
-    async def check_guild_freeze_status(self, guild_id: int):
-        """Get's a guild's freeze status from the api"""
-        guild = await Guild.get(guild_id, self.bot.session)
-        return guild.ensure_setting(constants.GuildSettings.level_freeze, False)
-
-    # Used only on cog_load. Not used for calculation, just for visual.
-    def generate_level_boundaries(self, amount):
-        """Generates level boundaries, used only for $level"""
-        last_level = 0
-        for x in range(1, amount):
-            level = int((1 + math.sqrt(1 + 8 * (x * x) / 40)) / 2)
-            if level > last_level:
-                self.level_boundaries[level] = x * x
-                last_level = level
+        """Fired every time a message is recieved from a guild. """
+        if self.global_freeze:
+            return
+
+        if msg.content.startswith(self.ignore_prefixes):
+            return
+
+        # Shared with the prefix lookup and the other cogs handling this message.
+        context = self.bot.message_context(msg)
+        guild = await context.guild()
+        if guild.ensure_setting(constants.GuildSettings.level_freeze, False):
+            return
+        if msg.content.startswith(self.guild_ignore_prefixes(guild)):
+            return
+
+        # Checked last, so messages that wouldn't earn XP anyway don't use up tokens.
+        if not self.xp_cooldown.allow(msg.guild.id, msg.author.id):
+            return
+
+        # Nobody is waiting on XP, don't let it queue in front of commands.
+        with self.bot.session.background():
+            await self.give_xp(msg, guild, await context.member(self.xp_buffer.get))
+
+    def guild_ignore_prefixes(self, guild: Guild) -> tuple:
+        """Get's a guild's own ignore prefixes, compiled once per cached copy of its settings"""
+        return guild_cache.derived(
+            guild.id,
+            "level.ignore_prefixes",
+            lambda: compile_prefixes(
+                guild.get_setting(constants.GuildSettings.level_ignore_chars)
+            ),
+        )
+
+    @commands.Cog.listener()
+    async def on_kat_level_xp_flush(self):
+        await self.flush_xp()
+
+    async def flush_xp(self):
+        """Write buffered XP back to the API."""
+        with self.bot.session.background():
+            flushed, failed = await self.xp_buffer.flush()
+        if flushed or failed:
+            self.log.debug(f"Flushed XP for {flushed} members, {failed} failed")
+
+    async def cog_shutdown(self):
+        await self.flush_xp()
+
+    def cog_unload(self):
+        # cog_unload can't be awaited, so let the final flush finish on its own.
+        with self.bot.session.background():
+            self.bot.loop.create_task(self.xp_buffer.flush())
+        super().cog_unload()
+
+    def get_curve(self, guild: Guild):
+        """Get's the level curve a guild has configured"""
+        k = guild.ensure_setting(constants.GuildSettings.level_curve, level_curve.DEFAULT_K)
+        try:
+            return level_curve.get_curve(k)
+        except (TypeError, ValueError):
+            self.log.warning(f"Guild {guild.id} has an invalid level curve: {k!r}")
+            return level_curve.get_curve()
 
     # Used when we need to award XP from message length.
-    async def xp_algorithm(self, msglen, guild):
+    def xp_algorithm(self, msglen, guild: Guild):
         return int(
             min(max((msglen / 0.9) * 0.3, 10), 200)
-            * (await Guild.get(guild.id, self.bot.session)).ensure_setting(
-                constants.GuildSettings.level_xp_multi, 1.0
-            )
+            * guild.ensure_setting(constants.GuildSettings.level_xp_multi, 1.0)
         )
 
     # The function that adds xp to user and calculates new levels.
-    async def give_xp(self, message):
-        member = await Member.get(message.guild.id, message.author.id, self.bot.session)
-        curr_xp = member.xp
+    async def give_xp(self, message, guild: Guild, member):
         curr_level = member.lvl
 
-        awarded_xp = await self.xp_algorithm(len(message.clean_content), message.guild)
-        new_xp = int(curr_xp + awarded_xp)
-        new_level = self.calculate_level(new_xp)
+        awarded_xp = self.xp_algorithm(len(message.clean_content), guild)
+        member.xp = int(member.xp + awarded_xp)
+        member.lvl = self.get_curve(guild).level(member.xp)
+        self.leaderboards.update(member)
+        self.ranks.update(member)
+
+        if self.xp_buffer.mark_dirty(member) and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = self.bot.loop.create_task(self.flush_xp())
 
-        if curr_level is not new_level:
+        if curr_level != member.lvl:
             await message.channel.send(
-                "You leveled up! **Level `{}`**".format(new_level), delete_after=5
+                "You leveled up! **Level `{}`**".format(member.lvl), delete_after=5
             )
 
-        member.xp = new_xp
-        member.lvl = new_level
-        await member.save(self.bot.session)
-
-    # Gets a level from xp amount
-    def calculate_level(self, xp):
-        return int((1 + math.sqrt(1 + 8 * (xp) / 40)) / 2)
-
     @commands.group()
     async def level(self, ctx):
         """Shows your current XP and level"""
@@ -95,10 +169,12 @@ class Level(KatCog):
             # If the user is running a subcommand of level, then do nothing.
             return
 
-        member = await Member.get(ctx.author.guild.id, ctx.author.id, self.bot.session)
+        context = self.bot.message_context(ctx.message)
+        guild = await context.guild()
+        member = await context.member(self.xp_buffer.get)
         xp, level = member.xp, member.lvl
         self.log.debug(f"{xp} {level}")
-        boundry = self.level_boundaries[int(level) + 1]
+        boundry = self.get_curve(guild).threshold(int(level) + 1)
 
         embed = discord.Embed(color=constants.Color.soft_green)
         embed.set_author(
@@ -106,32 +182,95 @@ class Level(KatCog):
             icon_url=ctx.author.avatar_url,
         )
         embed.description = ""
-        if self.global_freeze or await self.check_guild_freeze_status(ctx.guild.id):
+        if self.global_freeze or guild.ensure_setting(
+            constants.GuildSettings.level_freeze, False
+        ):
             embed.description += "⚠ Levels are currently frozen ⚠\n"
         if len(self.announcement) != 0:
             embed.description += self.announcement
         embed.add_field(
             name="Level `{}`".format(level), value="`{}xp / {}xp`".format(xp, boundry)
         )
+        try:
+            rank, total = await self.ranks.rank(member)
+            embed.add_field(name="Rank", value="`#{}` of {}".format(rank, total))
+        except Exception as e:
+            self.log.exception(e)
 
         await ctx.send(embed=embed)
 
-    # TODO: Implement this
-    @commands.command()
-    async def leaderboard(self, ctx):
-        """Shows the guild's top 10 users with the most XP"""
-        leaders = await Guild.leaderboard(ctx.guild.id, self.bot.session)
+    @level.command(hidden=True)
+    @commands.is_owner()
+    async def recalc(self, ctx, target: str = None, mode: str = "dry"):
+        """Recalculates member levels from their XP.
 
-        try:
-            string = "\n\n**Username  |  Level  |   XP**    \n"
-            for leader in leaders:
-                username = ctx.guild.get_member(leader.user_id).display_name
+        `$level recalc [guild id|all] [dry|apply]`, defaults to a dry run of this guild.
+        """
+        usage = "Usage: `$level recalc [guild id|all] [dry|apply]`"
+        if mode not in ("dry", "apply"):
+            await ctx.send(usage)
+            return
+        apply = mode == "apply"
+        if target == "all":
+            guild_ids = [guild.id for guild in self.bot.guilds]
+        else:
+            try:
+                guild_ids = [int(target) if target else ctx.guild.id]
+            except ValueError:
+                await ctx.send(usage)
+                return
 
-                string += "{}. {}   |   `{}`/`{}`\n".format(
-                    leaders.index(leader) + 1, username, leader.lvl, leader.xp
+        # Write out buffered XP first so we recalculate from up to date values.
+        await self.flush_xp()
+
+        report = []
+        # Not background, whose rate limit would make a large guild take minutes,
+        # but kept out of the interactive budget so commands aren't held up.
+        with self.bot.session.with_priority(Priority.MAINTENANCE):
+            for guild_id in guild_ids:
+                curve = self.get_curve(await Guild.get(guild_id, self.bot.session))
+                start = time.perf_counter()
+                total, changes, written, failed = await recalculate_levels(
+                    self.bot.session,
+                    guild_id,
+                    curve,
+                    apply=apply,
+                    bulk_endpoint=constants.Level.xp_bulk_endpoint,
+                    concurrency=constants.Level.xp_flush_concurrency,
                 )
-        except Exception as e:
-            self.log.exception(e)
+                elapsed = time.perf_counter() - start
+
+                line = f"{guild_id}: {len(changes)}/{total} changed in {elapsed:.2f}s"
+                if apply:
+                    line += f", {written} written, {failed} failed"
+                    # Buffered members and leaderboards still hold the old levels.
+                    self.xp_buffer.forget(guild_id)
+                    self.leaderboards.invalidate(guild_id)
+                for user_id, old, new in changes[:5]:
+                    line += f"\n  {user_id}: {old} -> {new}"
+                if len(changes) > 5:
+                    line += f"\n  ... {len(changes) - 5} more"
+                report.append(line)
+
+        self.log.info(f"Level recalc ({'apply' if apply else 'dry run'}):\n" + "\n".join(report))
+        header = "Applied" if apply else "Dry run, use `apply` to write changes"
+        message = header + "\n```" + "\n".join(report)
+        if len(message) > 1990:
+            message = message[:1990] + "\n..."
+        await ctx.send(message + "```")
+
+    @commands.command()
+    async def leaderboard(self, ctx, page: int = 1):
+        """Shows the guild's users with the most XP, a page at a time"""
+        leaders, page, pages = await self.leaderboards.page(
+            ctx.guild.id, page, constants.Level.leaderboard_page_size
+        )
+
+        string = "\n\n**Username  |  Level  |   XP**    \n"
+        for rank, user_id, xp, lvl in leaders:
+            member = ctx.guild.get_member(user_id)
+            username = member.display_name if member else f"Unknown user ({user_id})"
+            string += "{}. {}   |   `{}`/`{}`\n".format(rank, username, lvl, xp)
 
         embed = discord.Embed(color=constants.Color.soft_green)
         embed.set_author(
@@ -139,6 +278,7 @@ class Level(KatCog):
         )
         embed.description = self.announcement
         embed.description += string
+        embed.set_footer(text=f"Page {page}/{pages}")
         await ctx.send(embed=embed)
 
     @commands.command(hidden=True)
@@ -1,11 +1,11 @@
 import html
-import re
 
 from discord.ext import commands
 import discord
 from translate import Translator
 
 from bot.utils.extensions import KatCog, read_resource
+from bot.utils.dispatch import message_handler
 
 
 class Translate(KatCog):
@@ -27,24 +27,20 @@ class Translate(KatCog):
         # self.log.debug(type(translation))
         return html.unescape(translation)
 
-    @commands.Cog.listener()
+    @message_handler(pattern="[\u3040-\u30ff]")
     async def on_message(self, message):
         """If Hiragana or Katakana detected, attempt to translate"""
-        if message.author.bot:
-            return
-
-        if re.search("[\u3040-\u30ff]", message.content) is not None:
-            result = await self._translate("ja", "en", message.content)
-            embed = discord.Embed(colour=discord.Colour(0x2B2B2B), description=result)
-            embed.set_author(
-                name="{} Auto Translate".format(message.author.display_name),
-                icon_url=message.author.avatar_url,
-            )
-            embed.set_footer(
-                text="⚠️| Powered by opensource translations. May not be accurate."
-            )
-            # embed.set_footer(text="Options to disable auto translation are WIP.")
-            await message.channel.send(embed=embed)
+        result = await self._translate("ja", "en", message.content)
+        embed = discord.Embed(colour=discord.Colour(0x2B2B2B), description=result)
+        embed.set_author(
+            name="{} Auto Translate".format(message.author.display_name),
+            icon_url=message.author.avatar_url,
+        )
+        embed.set_footer(
+            text="⚠️| Powered by opensource translations. May not be accurate."
+        )
+        # embed.set_footer(text="Options to disable auto translation are WIP.")
+        await message.channel.send(embed=embed)
 
     @commands.command(aliases=["tlast", "translateuser", "tuser"])
     async def translatelast(self, ctx, user: discord.User, lang="en"):
@@ -1,6 +1,17 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import random
+import time
+
 import aiohttp
 
-from bot.utils import constants
+from bot.utils import codec, constants, logger
+from bot.utils.metrics import RequestStats
+from bot.utils.persistence import PersistentStore
+
+log = logger.get_logger(__name__)
 
 
 class ResponseStatusCodeException(Exception):
@@ -12,6 +23,148 @@ class ResponseStatusCodeException(Exception):
         return f"ResponseStatusCodeException: {self.code}: {self.message}"
 
 
+class APIUnavailableException(ResponseStatusCodeException):
+    """Raised when the API can't be reached, or its circuit breaker is open."""
+
+    def __init__(self, message):
+        super().__init__(503, message)
+
+    def __repr__(self):
+        return f"APIUnavailableException: {self.message}"
+
+
+# Methods that are safe to send again if we don't know whether the first attempt landed.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+
+def endpoint_family(endpoint: str) -> str:
+    """Return the top level resource of `endpoint`, e.g. `guilds/1/2` -> `guilds`."""
+    return endpoint.split("?", 1)[0].split("/", 1)[0]
+
+
+def route_template(endpoint: str) -> str:
+    """Return `endpoint` with its IDs replaced by placeholders.
+
+    e.g. `guilds/1/2` -> `guilds/{id}/{uid}`, `guilds/1/leaderboard?limit=10` -> `guilds/{id}/leaderboard`
+    """
+    names = iter(("{id}", "{uid}"))
+    parts = []
+    for part in endpoint.split("?", 1)[0].split("/"):
+        if part.isdigit():
+            part = next(names, "{n}")
+        parts.append(part)
+    return "/".join(parts)
+
+
+class Priority:
+    """Traffic classes for API requests, each with its own concurrency and rate budget."""
+
+    INTERACTIVE = "interactive"  # A user is waiting on the result, e.g. commands.
+    BACKGROUND = "background"  # Nobody is waiting, e.g. XP flushes and periodic events.
+    MAINTENANCE = "maintenance"  # Bulk owner commands, e.g. `$level recalc`.
+
+
+# Priority used when a request doesn't ask for one, see `APIClient.background`.
+_current_priority = contextvars.ContextVar("api_priority", default=Priority.INTERACTIVE)
+
+
+def set_task_priority(priority):
+    """Send every request from the current task, and tasks it starts, under `priority`."""
+    _current_priority.set(priority)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, in bursts of up to `burst`.
+
+    A `rate` of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TrafficClass:
+    """Concurrency and rate budget shared by every request of one `Priority`."""
+
+    def __init__(self, concurrency, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.waiting = 0
+
+    @classmethod
+    def from_config(cls, priority):
+        return cls(
+            constants.ApiTraffic[priority + "_concurrency"],
+            constants.ApiTraffic[priority + "_rate"],
+            constants.ApiTraffic[priority + "_burst"],
+        )
+
+
+# Routes whose documents are kept in the PersistentStore, when enabled.
+PERSISTED_ROUTES = ("guilds/{id}", "guilds/{id}/{uid}", "users/{id}")
+
+
+class CircuitBreaker:
+    """Stops requests to an endpoint family after repeated failures.
+
+    After `failure_threshold` consecutive failures the breaker opens and requests
+    fail fast for `reset_timeout` seconds. A single trial request is then let
+    through; success closes the breaker again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started_at = None
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Return whether a request may be sent right now."""
+        if self.opened_at is None:
+            return True
+
+        now = time.monotonic()
+        if now - self.opened_at < self.reset_timeout:
+            return False
+        # Only one trial at a time, unless the last one never reported back.
+        if self._trial_started_at is not None and now - self._trial_started_at < self.reset_timeout:
+            return False
+        self._trial_started_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_started_at = None
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
 class APIClient:
     """API Client
 
@@ -23,39 +176,335 @@ class APIClient:
         await post(endpoint, data: dict) ; returns JSON
         await patch(endpoint, data: dict) ; return JSON
         await delete(endpoint) ; returns 201
+
+    Concurrent GETs for the same endpoint are coalesced into a single request,
+    each caller receiving its own copy of the result.
+
+    Idempotent requests that fail with a connection error or 5xx are retried with
+    jittered exponential backoff. Each endpoint family (`guilds`, `users`, ...) has
+    its own `CircuitBreaker`; whilst it is open requests raise `APIUnavailableException`
+    straight away instead of hitting the API.
+
+    Every request sent is recorded against its `route_template` in `self.stats`.
+
+    With `api.persistence` enabled, guild, member and user documents are also kept in
+    a local `PersistentStore`. Whilst the API is unavailable GETs for them are served
+    from it, and writes are queued and replayed in order once requests succeed again.
+    Until then, GETs have the queued writes applied over whatever the API returns.
+
+    GET responses carrying an ETag or Last-Modified header are remembered, and later
+    GETs for the same endpoint are sent conditionally. A 304 reuses a copy of the decoded
+    body. Responses over `conditional_max_body` bytes aren't remembered, and the total
+    held is capped at `conditional_max_bytes`.
+
+    Requests are sent under a `Priority`, each with separate concurrency and rate limits
+    so background traffic can't starve commands. Pass `priority=` or wrap code in
+    `with session.background():` to send everything inside it as background traffic,
+    or `with session.with_priority(...):` for any other `Priority`.
     """
 
     def __init__(self):
         self.root_url = constants.Api.url
-        auth = constants.Api.auth_type + constants.Api.token
-        self.session = aiohttp.ClientSession(headers={"Authorization": auth})
+        self._headers = {"Authorization": constants.Api.auth_type + constants.Api.token}
+        self._session = None
+
+        self._inflight = {}  # endpoint: asyncio.Future of an in-flight GET
+        self._breakers = {}  # endpoint family: CircuitBreaker
+        self.stats = {}  # "METHOD route template": RequestStats
+
+        self.store = None
+        if constants.ApiPersistence.enabled:
+            self.store = PersistentStore(constants.ApiPersistence.path)
+        self._replay_task = None
+        self._traffic = {}  # Priority: TrafficClass, created once the loop is running
+        self._validators = OrderedDict()  # endpoint: (etag, last_modified, decoded body, bytes)
+        self._validator_bytes = 0  # Size of the remembered bodies as sent by the API
+        self.not_modified = 0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The aiohttp.ClientSession, created on first use so it binds to the running loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=constants.ApiConnection.limit,
+                limit_per_host=constants.ApiConnection.limit_per_host,
+                keepalive_timeout=constants.ApiConnection.keepalive_timeout,
+                ttl_dns_cache=constants.ApiConnection.dns_cache_ttl,
+            )
+            timeout = aiohttp.ClientTimeout(
+                connect=constants.ApiConnection.connect_timeout,
+                sock_read=constants.ApiConnection.read_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                headers=self._headers,
+                connector=connector,
+                timeout=timeout,
+                json_serialize=codec.dumps,
+            )
+        return self._session
 
     async def close(self):
         """Closes the aiohttp.ClientSession session"""
-        await self.session.close()
+        if self._session is not None:
+            await self._session.close()
+        if self.store is not None:
+            self.store.close()
+
+    def breaker(self, endpoint) -> CircuitBreaker:
+        """Return the CircuitBreaker guarding `endpoint`'s family."""
+        family = endpoint_family(endpoint)
+        if family not in self._breakers:
+            self._breakers[family] = CircuitBreaker(
+                constants.ApiRetry.failure_threshold, constants.ApiRetry.reset_timeout
+            )
+        return self._breakers[family]
+
+    @staticmethod
+    @contextmanager
+    def with_priority(priority):
+        """Send requests made inside this block, and tasks started from it, under `priority`."""
+        token = _current_priority.set(priority)
+        try:
+            yield
+        finally:
+            _current_priority.reset(token)
+
+    @staticmethod
+    def background():
+        """Send requests made inside this block, and tasks started from it, as background traffic."""
+        return APIClient.with_priority(Priority.BACKGROUND)
+
+    def traffic_class(self, priority) -> TrafficClass:
+        if priority not in self._traffic:
+            self._traffic[priority] = TrafficClass.from_config(priority)
+        return self._traffic[priority]
+
+    def cached(self, endpoint):
+        """Return the last persisted document for `endpoint` without touching the network."""
+        if self.store is None:
+            return None
+        return self.store.get(endpoint)
+
+    async def request(self, method, endpoint, json=None, priority=None) -> dict:
+        priority = priority or _current_priority.get()
+        if self.store is None or route_template(endpoint) not in PERSISTED_ROUTES:
+            result = await self._request(method, endpoint, json, priority)
+            self._maybe_replay()
+            return result
+
+        if method != "GET" and self.store.pending:
+            # Stay in order behind the writes still waiting to be replayed, and
+            # retry the replay in case the last attempt stopped on an error.
+            self._queue_write(method, endpoint, json)
+            self._maybe_replay()
+            return json
+
+        try:
+            result = await self._request(method, endpoint, json, priority)
+        except ResponseStatusCodeException as e:
+            if e.code < 500:
+                raise
+            if method != "GET":
+                self._queue_write(method, endpoint, json)
+                return json
+            stale = self.store.get(endpoint)
+            if stale is None:
+                raise
+            return stale
+
+        if method == "GET":
+            # Writes waiting to be replayed are newer than what the API just sent.
+            result = self.store.apply_pending(endpoint, result)
+            self.store.put(endpoint, result)
+        elif method == "PATCH":
+            self.store.merge(endpoint, json)
+        self._maybe_replay()
+        return result
 
-    async def request(self, method, endpoint, json=None) -> dict:
-        async with self.session.request(method, self.root_url + endpoint, json=json) as resp:
-            if resp.status < 400:
-                json = await resp.json()
-                return json.get("data", json)
+    def _queue_write(self, method, endpoint, json):
+        log.warning(f"API unavailable, queued {method} {endpoint} for replay")
+        self.store.queue_write(method, endpoint, json)
+        if method == "PATCH":
+            self.store.merge(endpoint, json)
+
+    def _maybe_replay(self):
+        """Start replaying queued writes if there are any and we aren't already."""
+        if self.store is None or not self.store.pending:
+            return
+        if self._replay_task is None or self._replay_task.done():
+            self._replay_task = asyncio.ensure_future(self.replay_writes())
+
+    async def replay_writes(self):
+        """Send queued writes in order, stopping at the first the API still can't take."""
+        # Imported here, models imports this module.
+        from bot.utils.models import guild_cache
+
+        for write_id, method, endpoint, data in self.store.pending_writes():
             try:
-                raise ResponseStatusCodeException(resp.status, await resp.json())
-            except aiohttp.client_exceptions.ContentTypeError:
-                raise ResponseStatusCodeException(resp.status, None)
+                await self._request(method, endpoint, data, Priority.BACKGROUND)
+            except ResponseStatusCodeException as e:
+                if e.code >= 500:
+                    return
+                log.warning(f"Dropped queued {method} {endpoint}, API rejected it: {e.code}")
+            self.store.drop_write(write_id)
+            if route_template(endpoint) == "guilds/{id}":
+                # Settings cached whilst the write was queued may not include it.
+                guild_cache.invalidate(int(endpoint.split("/")[1]))
+            log.info(f"Replayed queued {method} {endpoint}")
+
+    async def _request(self, method, endpoint, json=None, priority=Priority.INTERACTIVE) -> dict:
+        breaker = self.breaker(endpoint)
+        attempts = constants.ApiRetry.attempts if method in IDEMPOTENT_METHODS else 1
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise APIUnavailableException(
+                    f"Circuit open for `{endpoint_family(endpoint)}`"
+                )
+
+            try:
+                result = await self._send(method, endpoint, json, priority)
+            except ResponseStatusCodeException as e:
+                if e.code < 500:
+                    # The API is up, the request itself was bad.
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                error = e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                error = APIUnavailableException(f"{type(e).__name__}: {e}")
+            else:
+                breaker.record_success()
+                return result
+
+            if attempt + 1 < attempts:
+                await asyncio.sleep(self._backoff(attempt))
+
+        raise error
+
+    @staticmethod
+    def _backoff(attempt) -> float:
+        """Full jitter exponential backoff for retry number `attempt`."""
+        ceiling = min(
+            constants.ApiRetry.backoff_max, constants.ApiRetry.backoff_base * 2 ** attempt
+        )
+        return random.uniform(0, ceiling)
+
+    async def _send(self, method, endpoint, json=None, priority=Priority.INTERACTIVE) -> dict:
+        key = f"{method} {route_template(endpoint)}"
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = RequestStats()
 
-    async def get(self, endpoint) -> dict:
+        traffic = self.traffic_class(priority)
+        traffic.waiting += 1
+        try:
+            await traffic.bucket.acquire()
+            await traffic.semaphore.acquire()
+        finally:
+            traffic.waiting -= 1
+        try:
+            return await self._send_now(method, endpoint, json, stats)
+        finally:
+            traffic.semaphore.release()
+
+    async def _send_now(self, method, endpoint, json, stats) -> dict:
+        headers = None
+        validator = self._validators.get(endpoint) if method == "GET" else None
+        if validator is not None:
+            etag, last_modified, _, _ = validator
+            headers = {}
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        start = time.perf_counter()
+        nbytes = 0
+        error = True
+        try:
+            async with self.session.request(
+                method, self.root_url + endpoint, json=json, headers=headers
+            ) as resp:
+                if resp.status == 304 and validator is not None:
+                    error = False
+                    self.not_modified += 1
+                    self._validators.move_to_end(endpoint)
+                    # Callers may mutate what they get, the remembered body must stay as sent.
+                    return codec.copy(validator[2])
+
+                nbytes = len(await resp.read())
+                if resp.status < 400:
+                    json = await resp.json(loads=codec.loads)
+                    error = False
+                    result = json.get("data", json)
+                    if method == "GET":
+                        self._remember_validator(endpoint, resp.headers, result, nbytes)
+                    return result
+                try:
+                    raise ResponseStatusCodeException(
+                        resp.status, await resp.json(loads=codec.loads)
+                    )
+                except aiohttp.client_exceptions.ContentTypeError:
+                    raise ResponseStatusCodeException(resp.status, None)
+        finally:
+            stats.record((time.perf_counter() - start) * 1000, nbytes, error)
+
+    def _remember_validator(self, endpoint, headers, result, nbytes):
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        forgotten = self._validators.pop(endpoint, None)
+        if forgotten is not None:
+            self._validator_bytes -= forgotten[3]
+        # Large responses, like whole guild member lists, cost more to hold than to re-fetch.
+        if (not etag and not last_modified) or nbytes > constants.ApiCache.conditional_max_body:
+            return
+
+        self._validators[endpoint] = (etag, last_modified, codec.copy(result), nbytes)
+        self._validator_bytes += nbytes
+        while (
+            len(self._validators) > constants.ApiCache.conditional_max_size
+            or self._validator_bytes > constants.ApiCache.conditional_max_bytes
+        ):
+            _, evicted = self._validators.popitem(last=False)
+            self._validator_bytes -= evicted[3]
+
+    def get_stats(self, top=None) -> dict:
+        """Return request stats per route, busiest first, optionally only the `top` few."""
+        ordered = sorted(self.stats.items(), key=lambda kv: kv[1].requests, reverse=True)
+        return {route: stats.to_dict() for route, stats in ordered[:top]}
+
+    def get_queue_depths(self) -> dict:
+        """Return how many requests of each `Priority` are waiting for a rate or concurrency slot."""
+        return {priority: traffic.waiting for priority, traffic in self._traffic.items()}
+
+    async def get(self, endpoint, priority=None) -> dict:
         """API GET request"""
-        return await self.request("GET", endpoint)
+        future = self._inflight.get(endpoint)
+        if future is None:
+            future = asyncio.ensure_future(self.request("GET", endpoint, priority=priority))
+            self._inflight[endpoint] = future
+            future.add_done_callback(lambda f: self._request_done(endpoint, f))
+
+        # Shield the shared request so one caller being cancelled doesn't cancel it for the rest.
+        return codec.copy(await asyncio.shield(future))
+
+    def _request_done(self, endpoint, future):
+        if self._inflight.get(endpoint) is future:
+            del self._inflight[endpoint]
+        if not future.cancelled():
+            # Mark the exception as retrieved in case every waiter was cancelled.
+            future.exception()
 
-    async def post(self, endpoint, data) -> dict:
+    async def post(self, endpoint, data, priority=None) -> dict:
         """API POST request"""
-        return await self.request("POST", endpoint, json=data)
+        return await self.request("POST", endpoint, json=data, priority=priority)
 
-    async def patch(self, endpoint, data) -> dict:
+    async def patch(self, endpoint, data, priority=None) -> dict:
         """API PATCH request"""
-        return await self.request("PATCH", endpoint, json=data)
+        return await self.request("PATCH", endpoint, json=data, priority=priority)
 
-    async def delete(self, endpoint) -> dict:
+    async def delete(self, endpoint, priority=None) -> dict:
         """API DELETE request"""
-        return await self.request("DELETE", endpoint)
+        return await self.request("DELETE", endpoint, priority=priority)
@@ -0,0 +1,42 @@
+"""JSON codec used for Kat API payloads.
+
+Picks the fastest JSON library installed: orjson, then ujson, falling back to
+the stdlib `json` module. All three produce the same documents for the plain
+dict/list/str/int/float/bool/None data the API deals in.
+
+    dumps(obj) -> str
+    loads(str | bytes) -> obj
+    copy(obj) -> obj        ; deep copy of a JSON document via a dumps/loads round trip
+"""
+try:
+    import orjson
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+    NAME = "orjson"
+
+except ImportError:
+    try:
+        import ujson
+
+        def dumps(obj) -> str:
+            return ujson.dumps(obj, ensure_ascii=False)
+
+        loads = ujson.loads
+        NAME = "ujson"
+
+    except ImportError:
+        import json
+
+        def dumps(obj) -> str:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+        loads = json.loads
+        NAME = "json"
+
+
+def copy(obj):
+    """Deep copy a JSON document. Faster than `copy.deepcopy` for plain JSON data."""
+    return loads(dumps(obj))
@@ -0,0 +1,412 @@
+"""Helpers for the Level cog."""
+from collections import OrderedDict
+import asyncio
+import bisect
+import time
+
+from bot.utils.models import Guild, Member
+
+
+def compile_prefixes(prefixes) -> tuple:
+    """Compile a list of ignore prefixes into a tuple for a single `str.startswith` call.
+
+    Accepts a single string too. Empty prefixes are dropped, they would match everything.
+    """
+    if not prefixes:
+        return ()
+    if isinstance(prefixes, str):
+        prefixes = [prefixes]
+    return tuple(sorted({str(prefix) for prefix in prefixes if prefix}))
+
+
+class XPCooldown:
+    """Per member token bucket deciding which messages earn XP.
+
+    Each (guild_id, user_id) may earn XP for `burst` messages in a row, after which
+    one more message becomes eligible every `per` seconds. Everything is kept in
+    memory; members idle long enough for a full bucket are forgotten, since a new
+    entry would be identical.
+
+    `per`   : float ; Seconds to regain one eligible message.
+    `burst` : int   ; Eligible messages that can be saved up.
+    """
+
+    def __init__(self, per=20, burst=3):
+        self.per = per
+        self.burst = burst
+        self._idle_after = per * burst
+
+        # (guild_id, user_id): (tokens, updated_at), least recently touched first.
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, guild_id, user_id, now=None) -> bool:
+        """Take a token for the member, returning `False` if they are on cooldown."""
+        if self.per <= 0:
+            return True
+        if now is None:
+            now = time.monotonic()
+        self._expire(now)
+
+        key = (guild_id, user_id)
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) / self.per)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        return allowed
+
+    def _expire(self, now):
+        while self._buckets:
+            key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < self._idle_after:
+                break
+            del self._buckets[key]
+
+
+class XPBuffer:
+    """Write-behind buffer for member XP.
+
+    Members are fetched from the API the first time they are touched, after which
+    their XP and level live in memory and are only written back on `flush`.
+
+    `session`       : APIClient ; Session used to load and save members.
+    `flush_size`    : int       ; Dirty member count at which a flush is due.
+    `bulk_endpoint` : str       ; Optional endpoint accepting a list of members per guild,
+                                  formatted with `gid`. When unset, members are PATCHed
+                                  individually, `concurrency` at a time.
+    `retry_delay`   : float     ; Seconds after a failed flush before `flush_size` can
+                                  trigger another, failed members wait for the next
+                                  regular flush instead of being resent on every award.
+    """
+
+    def __init__(
+        self, session, flush_size=200, bulk_endpoint=None, concurrency=10, retry_delay=60
+    ):
+        self.session = session
+        self.flush_size = flush_size
+        self.bulk_endpoint = bulk_endpoint
+        self.concurrency = concurrency
+        self.retry_delay = retry_delay
+
+        self._members = {}  # (guild_id, user_id): Member
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._retry_at = 0.0  # monotonic time the size trigger is allowed again
+
+    @property
+    def dirty_count(self):
+        return len(self._dirty)
+
+    async def get(self, guild_id, user_id) -> Member:
+        """Return the buffered `Member`, loading it from the API if we don't hold it."""
+        key = (guild_id, user_id)
+        member = self._members.get(key)
+        if member is None:
+            member = await Member.get(guild_id, user_id, self.session)
+            # Someone else may have loaded (and modified) them whilst we awaited.
+            member = self._members.setdefault(key, member)
+        return member
+
+    def guild_members(self, guild_id):
+        """Yield every buffered member of `guild_id`."""
+        for (gid, _), member in list(self._members.items()):
+            if gid == guild_id:
+                yield member
+
+    def forget(self, guild_id):
+        """Drop buffered members of `guild_id` that have nothing left to write."""
+        for key in [k for k in self._members if k[0] == guild_id and k not in self._dirty]:
+            del self._members[key]
+
+    def mark_dirty(self, member: Member) -> bool:
+        """Queue `member` to be written on the next flush.
+
+        Returns `True` once enough members are dirty that a flush should be run now,
+        unless the last flush failed less than `retry_delay` seconds ago.
+        """
+        key = (member.guild_id, member.user_id)
+        self._members[key] = member
+        self._dirty.add(key)
+        return len(self._dirty) >= self.flush_size and time.monotonic() >= self._retry_at
+
+    async def flush(self):
+        """Write every dirty member back to the API.
+
+        Returns a tuple of (flushed, failed). Failed members stay dirty for the next flush.
+        """
+        async with self._flush_lock:
+            keys, self._dirty = self._dirty, set()
+
+            # Members that stayed clean for a whole flush period are dropped so the
+            # buffer only holds recently active members.
+            for key in set(self._members) - keys:
+                del self._members[key]
+
+            if not keys:
+                return 0, 0
+
+            members = [self._members[key] for key in keys]
+            if self.bulk_endpoint:
+                failed = await self._flush_bulk(members)
+            else:
+                failed = await self._flush_each(members)
+
+            for member in failed:
+                self._dirty.add((member.guild_id, member.user_id))
+            self._retry_at = time.monotonic() + self.retry_delay if failed else 0.0
+            return len(members) - len(failed), len(failed)
+
+    async def _flush_each(self, members):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def _save(member):
+            async with semaphore:
+                await member.save(self.session)
+
+        results = await asyncio.gather(
+            *(_save(member) for member in members), return_exceptions=True
+        )
+        return [m for m, r in zip(members, results) if isinstance(r, Exception)]
+
+    async def _flush_bulk(self, members):
+        by_guild = {}
+        for member in members:
+            by_guild.setdefault(member.guild_id, []).append(member)
+
+        failed = []
+        for guild_id, guild_members in by_guild.items():
+            changes = [member.pop_changes() for member in guild_members]
+            try:
+                await self.session.patch(
+                    self.bulk_endpoint.format(gid=guild_id),
+                    [m.to_patch(c) for m, c in zip(guild_members, changes)],
+                )
+            except Exception:
+                for member, dirty in zip(guild_members, changes):
+                    member.restore_changes(dirty)
+                failed.extend(guild_members)
+        return failed
+
+
+async def recalculate_levels(
+    session, guild_id, curve, apply=False, bulk_endpoint=None, concurrency=10
+):
+    """Recompute the level of every member of a guild from their XP.
+
+    Levels for the whole guild are computed in one pass with `curve.levels`. When
+    `apply` is set, only members whose level changed are written back.
+
+    Returns a tuple of (total, changes, written, failed), `changes` being a list of
+    (user_id, old_level, new_level).
+    """
+    members = await Guild.members(guild_id, session) or []
+    levels = curve.levels([member.xp for member in members])
+
+    changed = [(m, lvl) for m, lvl in zip(members, levels) if m.lvl != lvl]
+    changes = [(m.user_id, m.lvl, lvl) for m, lvl in changed]
+    if not apply or not changed:
+        return len(members), changes, 0, 0
+
+    writer = XPBuffer(
+        session, flush_size=len(changed), bulk_endpoint=bulk_endpoint, concurrency=concurrency
+    )
+    for member, lvl in changed:
+        member.lvl = lvl
+        writer.mark_dirty(member)
+    written, failed = await writer.flush()
+    return len(members), changes, written, failed
+
+
+class Leaderboard:
+    """Per guild top-K leaderboards held in memory.
+
+    Each guild's board is loaded from the API the first time it is asked for and
+    kept current with `update` as XP is awarded. It is re-fetched at most once
+    every `refresh_interval` seconds to pick up changes made elsewhere.
+
+    `session`           : APIClient ; Session used to load leaderboards.
+    `size`              : int       ; Members kept per guild.
+    `refresh_interval`  : int       ; Seconds before a board is re-fetched from the API.
+    `buffer`            : XPBuffer  ; Optional buffer whose unsaved XP is applied over fetched boards.
+    """
+
+    def __init__(self, session, size=100, refresh_interval=300, buffer=None):
+        self.session = session
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.buffer = buffer
+
+        # guild_id: [(-xp, user_id, level), ...], sorted so the highest XP comes first.
+        self._boards = {}
+        self._loaded_at = {}  # guild_id: monotonic time
+        self._locks = {}  # guild_id: asyncio.Lock
+
+    async def get(self, guild_id) -> list:
+        """Return the guild's board as a list of (user_id, xp, level), highest XP first."""
+        loaded_at = self._loaded_at.get(guild_id)
+        if loaded_at is None or time.monotonic() - loaded_at > self.refresh_interval:
+            lock = self._locks.get(guild_id)
+            if lock is None:
+                lock = self._locks[guild_id] = asyncio.Lock()
+            async with lock:
+                # Another caller may have refreshed it whilst we waited.
+                if self._loaded_at.get(guild_id, loaded_at) == loaded_at:
+                    await self.refresh(guild_id)
+        return [(uid, -neg_xp, lvl) for neg_xp, uid, lvl in self._boards.get(guild_id, [])]
+
+    async def page(self, guild_id, page=1, per_page=10):
+        """Return one page of the guild's board as (rows, page, pages).
+
+        Rows are (rank, user_id, xp, level). Out of range pages are clamped.
+        """
+        board = await self.get(guild_id)
+        pages = max(1, -(-len(board) // per_page))
+        page = min(max(page, 1), pages)
+        start = (page - 1) * per_page
+        rows = [
+            (rank, uid, xp, lvl)
+            for rank, (uid, xp, lvl) in enumerate(board[start:start + per_page], start + 1)
+        ]
+        return rows, page, pages
+
+    async def refresh(self, guild_id):
+        """Re-fetch the guild's board from the API."""
+        leaders = await Guild.leaderboard(guild_id, self.session, limit=self.size) or []
+        self._boards[guild_id] = sorted(
+            (-member.xp, member.user_id, member.lvl) for member in leaders
+        )
+        self._loaded_at[guild_id] = time.monotonic()
+
+        # The API doesn't know about XP that is still waiting to be flushed.
+        if self.buffer is not None:
+            for member in self.buffer.guild_members(guild_id):
+                self.update(member)
+
+    def update(self, member: Member):
+        """Apply `member`'s current XP to their guild's board, if it is loaded."""
+        board = self._boards.get(member.guild_id)
+        if board is None:
+            return
+
+        for i, (_, uid, _) in enumerate(board):
+            if uid == member.user_id:
+                del board[i]
+                break
+
+        entry = (-member.xp, member.user_id, member.lvl)
+        if len(board) < self.size or entry < board[-1]:
+            bisect.insort(board, entry)
+            del board[self.size:]
+
+    def invalidate(self, guild_id):
+        """Forget the guild's board, it is re-fetched next time it is asked for."""
+        self._boards.pop(guild_id, None)
+        self._loaded_at.pop(guild_id, None)
+
+
+class RankIndex:
+    """Per guild index of member XP for answering rank queries locally.
+
+    Each guild's index is built from `Guild.members` the first time it is queried,
+    and kept current with `update` as XP is awarded. It holds every member's XP in
+    a sorted list, so a rank is a single bisect. Like `Leaderboard`, an index is
+    rebuilt at most once every `refresh_interval` seconds to pick up changes made
+    elsewhere, and only the `max_guilds` most recently queried guilds are kept.
+
+    `session`           : APIClient ; Session used to load guild members.
+    `refresh_interval`  : int       ; Seconds before an index is rebuilt from the API.
+    `max_guilds`        : int       ; Guilds indexed at once, least recently queried are dropped.
+    `buffer`            : XPBuffer  ; Optional buffer whose unsaved XP is applied over fetched members.
+    """
+
+    def __init__(self, session, refresh_interval=300, max_guilds=50, buffer=None):
+        self.session = session
+        self.refresh_interval = refresh_interval
+        self.max_guilds = max_guilds
+        self.buffer = buffer
+
+        self._xp = {}  # guild_id: {user_id: xp}
+        self._sorted = {}  # guild_id: [xp, ...] ascending
+        self._loaded_at = OrderedDict()  # guild_id: monotonic time, least recently queried first
+        self._loading = {}  # guild_id: {user_id: xp} awarded whilst the index was being fetched
+        self._locks = {}  # guild_id: asyncio.Lock
+
+    def __len__(self):
+        return len(self._sorted)
+
+    async def load(self, guild_id):
+        """Build the guild's index from the API, unless it is built and recent enough."""
+        loaded_at = self._loaded_at.get(guild_id)
+        if loaded_at is not None and time.monotonic() - loaded_at <= self.refresh_interval:
+            return
+        lock = self._locks.get(guild_id)
+        if lock is None:
+            lock = self._locks[guild_id] = asyncio.Lock()
+        async with lock:
+            # Another caller may have loaded it whilst we waited.
+            if self._loaded_at.get(guild_id, loaded_at) != loaded_at:
+                return
+            self._loading[guild_id] = {}
+            try:
+                members = await Guild.members(guild_id, self.session) or []
+            finally:
+                awarded = self._loading.pop(guild_id)
+
+            xp = {member.user_id: member.xp for member in members}
+            # The API doesn't know about XP still waiting to be flushed,
+            # or anything awarded whilst we were fetching.
+            if self.buffer is not None:
+                xp.update((m.user_id, m.xp) for m in self.buffer.guild_members(guild_id))
+            xp.update(awarded)
+            self._xp[guild_id] = xp
+            self._sorted[guild_id] = sorted(xp.values())
+            self._loaded_at[guild_id] = time.monotonic()
+            self._loaded_at.move_to_end(guild_id)
+            self._evict()
+
+    def _evict(self):
+        while len(self._loaded_at) > self.max_guilds:
+            guild_id, _ = self._loaded_at.popitem(last=False)
+            self._xp.pop(guild_id, None)
+            self._sorted.pop(guild_id, None)
+            lock = self._locks.get(guild_id)
+            if lock is not None and not lock.locked():
+                del self._locks[guild_id]
+
+    async def rank(self, member: Member):
+        """Return (rank, total) of `member` within their guild, rank 1 being the most XP."""
+        await self.load(member.guild_id)
+        self.update(member)
+        self._loaded_at.move_to_end(member.guild_id)
+        xps = self._sorted[member.guild_id]
+        return len(xps) - bisect.bisect_right(xps, member.xp) + 1, len(xps)
+
+    def update(self, member: Member):
+        """Apply `member`'s current XP to their guild's index, if it is loaded."""
+        awarded = self._loading.get(member.guild_id)
+        if awarded is not None:
+            # Keep track of it for when the index finishes loading.
+            awarded[member.user_id] = member.xp
+
+        xp = self._xp.get(member.guild_id)
+        xps = self._sorted.get(member.guild_id)
+        if xps is None:
+            return
+
+        old = xp.get(member.user_id)
+        if old == member.xp:
+            return
+        if old is not None:
+            del xps[bisect.bisect_left(xps, old)]
+        bisect.insort(xps, member.xp)
+        xp[member.user_id] = member.xp
+
+    def invalidate(self, guild_id):
+        """Forget the guild's index, it is rebuilt next time it is queried."""
+        self._xp.pop(guild_id, None)
+        self._sorted.pop(guild_id, None)
+        self._loaded_at.pop(guild_id, None)
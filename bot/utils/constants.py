@@ -95,6 +95,64 @@ class Api(metaclass=YAMLGetter):
     token: str
 
 
+class ApiCache(metaclass=YAMLGetter):
+    section = "api"
+    subsection = "cache"
+
+    ttl: int
+    max_size: int
+    prefetch_concurrency: int
+    conditional_max_size: int
+    conditional_max_body: int
+    conditional_max_bytes: int
+
+
+class ApiConnection(metaclass=YAMLGetter):
+    section = "api"
+    subsection = "connection"
+
+    limit: int
+    limit_per_host: int
+    keepalive_timeout: int
+    dns_cache_ttl: int
+    connect_timeout: float
+    read_timeout: float
+
+
+class ApiRetry(metaclass=YAMLGetter):
+    section = "api"
+    subsection = "retry"
+
+    attempts: int
+    backoff_base: float
+    backoff_max: float
+    failure_threshold: int
+    reset_timeout: int
+
+
+class ApiTraffic(metaclass=YAMLGetter):
+    section = "api"
+    subsection = "traffic"
+
+    interactive_concurrency: int
+    interactive_rate: float
+    interactive_burst: int
+    background_concurrency: int
+    background_rate: float
+    background_burst: int
+    maintenance_concurrency: int
+    maintenance_rate: float
+    maintenance_burst: int
+
+
+class ApiPersistence(metaclass=YAMLGetter):
+    section = "api"
+    subsection = "persistence"
+
+    enabled: bool
+    path: str
+
+
 #  Cog specific data classes
 class Core(metaclass=YAMLGetter):
     section = "cogs"
@@ -136,6 +194,16 @@ class Level(metaclass=YAMLGetter):
     subsection = "level"
 
     ignore_chars: Optional[List[str]]
+    xp_cooldown_per: float
+    xp_cooldown_burst: int
+    xp_flush_interval: int
+    xp_flush_size: int
+    xp_flush_concurrency: int
+    xp_bulk_endpoint: Optional[str]
+    leaderboard_size: int
+    leaderboard_refresh: int
+    leaderboard_page_size: int
+    rank_index_guilds: int
 
 
 class Configurator(metaclass=YAMLGetter):
@@ -151,6 +219,7 @@ class Fun(metaclass=YAMLGetter):
 
     api_key: str
     anon_key: str
+    megumonday: str
 
 
 class Dyndns(metaclass=YAMLGetter):
@@ -174,6 +243,9 @@ class EventManager(metaclass=YAMLGetter):
 
     max_event_timer: int
     debug: bool
+    timezone: str
+    markers_path: str
+    policy: str
 
     events: List[dict]
 
@@ -204,6 +276,8 @@ class GuildSettings(metaclass=YAMLGetter):
     fun_counter: str
     level_freeze: str
     level_xp_multi: str
+    level_curve: str
+    level_ignore_chars: str
     roles_moderators: str
     roles_admins: str
 
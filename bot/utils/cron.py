@@ -0,0 +1,135 @@
+"""Cron expressions for wall-clock aligned events.
+
+Standard five field expressions, `minute hour day-of-month month day-of-week`.
+Fields take `*`, numbers, ranges (`1-5`), steps (`*/15`, `0-30/10`) and comma
+separated lists of those. Day of week runs 0-6 from Sunday, 7 is also Sunday.
+As in cron, when both day fields are restricted a day matching either is used.
+
+    schedule = CronSchedule("0 9 * * 1", timezone="Europe/London")
+    schedule.next_after(time.time())  -> float ; POSIX timestamp of the next run
+"""
+import datetime
+
+try:
+    import zoneinfo
+except ImportError:  # Python < 3.9
+    try:
+        from backports import zoneinfo
+    except ImportError:
+        zoneinfo = None
+
+
+# (low, high) of each field.
+FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# How far ahead to look before deciding an expression can never match, e.g. "0 0 30 2 *".
+MAX_DAYS_AHEAD = 366 * 5
+
+
+def get_timezone(name):
+    """Return the `tzinfo` for `name`, falling back to UTC if it isn't available.
+
+    Needs `zoneinfo`, or `backports.zoneinfo` before Python 3.9, and a timezone
+    database; `tzdata` provides one where the system doesn't.
+
+    Returns a tuple of (tzinfo, fell_back).
+    """
+    if not name or name.upper() == "UTC":
+        return datetime.timezone.utc, False
+    if zoneinfo is None:
+        return datetime.timezone.utc, True
+    try:
+        return zoneinfo.ZoneInfo(name), False
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return datetime.timezone.utc, True
+
+
+def _parse_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step = part.split("/", 1)
+            step = int(step)
+            if step < 1:
+                raise ValueError(f"Invalid step in `{field}`")
+
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = int(part)
+            # `5/15` means every 15 from 5 onwards.
+            end = high if step > 1 else start
+
+        if not low <= start <= end <= high:
+            raise ValueError(f"`{field}` is out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """Parsed cron expression.
+
+    `expression`    : str   ; Five field cron expression.
+    `timezone`      : str   ; IANA timezone the expression is evaluated in, default UTC.
+    """
+
+    __slots__ = ("expression", "tz", "minutes", "hours", "days", "months", "weekdays", "_any_day")
+
+    def __init__(self, expression, timezone=None):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression `{expression}` must have 5 fields")
+
+        self.expression = expression
+        self.tz, _ = get_timezone(timezone)
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _parse_field(field, low, high) for field, (low, high) in zip(fields, FIELDS)
+        )
+        # Cron counts from Sunday, datetime.weekday() from Monday.
+        self.weekdays = frozenset((day - 1) % 7 for day in weekdays)
+
+        day_any, weekday_any = fields[2] == "*", fields[4] == "*"
+        # Both restricted: either may match. One restricted: only that one counts.
+        self._any_day = (day_any, weekday_any)
+
+    def _day_matches(self, date) -> bool:
+        if date.month not in self.months:
+            return False
+        day_any, weekday_any = self._any_day
+        in_days = date.day in self.days
+        in_weekdays = date.weekday() in self.weekdays
+        if day_any and weekday_any:
+            return True
+        if day_any:
+            return in_weekdays
+        if weekday_any:
+            return in_days
+        return in_days or in_weekdays
+
+    def next_after(self, timestamp) -> float:
+        """Return the POSIX timestamp of the first run strictly after `timestamp`."""
+        start = datetime.datetime.fromtimestamp(timestamp, self.tz).replace(
+            tzinfo=None, second=0, microsecond=0
+        ) + datetime.timedelta(minutes=1)
+
+        hours = sorted(self.hours)
+        minutes = sorted(self.minutes)
+        day = start.date()
+        for _ in range(MAX_DAYS_AHEAD):
+            if self._day_matches(day):
+                for hour in hours:
+                    for minute in minutes:
+                        local = datetime.datetime.combine(day, datetime.time(hour, minute))
+                        if local < start:
+                            continue
+                        fire = local.replace(tzinfo=self.tz).timestamp()
+                        if fire > timestamp:
+                            return fire
+            day += datetime.timedelta(days=1)
+        raise ValueError(f"Cron expression `{self.expression}` never matches")
+
+    def __repr__(self):
+        return f"<CronSchedule '{self.expression}' {self.tz}>"
@@ -0,0 +1,172 @@
+"""Central routing of messages to cog handlers.
+
+Instead of every cog registering a raw `on_message` listener and re-checking the
+same things, cogs mark handlers with `message_handler` and declare what they care
+about. `MessageDispatcher` works out the shared facts about a message once
+(bot author, DM or guild, home guild) and only calls the handlers whose filters
+match, timing each call.
+
+    class Fun(KatCog):
+        @message_handler(home_guild_only=True, pattern=r"(?i)gorl")
+        async def gorl(self, message):
+            ...
+"""
+import asyncio
+import re
+import time
+
+from bot.utils.metrics import RequestStats
+
+# Attribute a handler's MessageFilter is stored under.
+FILTER_ATTR = "__kat_message_filter__"
+
+# Route buckets, a message is checked against "any" and the bucket for where it was sent.
+ANY, GUILD, DM, HOME = "any", "guild", "dm", "home"
+
+
+class MessageFilter:
+    """What a message handler wants to see.
+
+    `guild_only`        : bool          ; Only messages sent in a guild.
+    `dm_only`           : bool          ; Only direct messages.
+    `home_guild_only`   : bool          ; Only messages sent in one of `HomeGuild.ids`.
+    `pattern`           : str           ; Regex that must match somewhere in the content.
+    `prefix`            : str | list    ; Prefix (or prefixes) the content must start with.
+    `bots`              : bool          ; Also receive messages sent by bots.
+    """
+
+    __slots__ = ("route", "pattern", "prefix", "bots")
+
+    def __init__(
+        self,
+        guild_only=False,
+        dm_only=False,
+        home_guild_only=False,
+        pattern=None,
+        prefix=None,
+        bots=False,
+    ):
+        if sum((guild_only, dm_only, home_guild_only)) > 1:
+            raise ValueError("Only one of guild_only, dm_only and home_guild_only can be set")
+
+        if home_guild_only:
+            self.route = HOME
+        elif guild_only:
+            self.route = GUILD
+        elif dm_only:
+            self.route = DM
+        else:
+            self.route = ANY
+
+        self.pattern = re.compile(pattern) if pattern else None
+        if isinstance(prefix, str):
+            prefix = (prefix,)
+        self.prefix = tuple(prefix) if prefix else None
+        self.bots = bots
+
+    def matches(self, content) -> bool:
+        """Check the per-handler content filters. Routing has already been checked."""
+        if self.prefix is not None and not content.startswith(self.prefix):
+            return False
+        if self.pattern is not None and self.pattern.search(content) is None:
+            return False
+        return True
+
+
+def message_handler(**filters):
+    """Mark a `KatCog` method as a message handler, see `MessageFilter` for `filters`."""
+    message_filter = MessageFilter(**filters)
+
+    def decorator(func):
+        if not asyncio.iscoroutinefunction(func):
+            raise TypeError("Message handlers must be coroutines")
+        setattr(func, FILTER_ATTR, message_filter)
+        return func
+
+    return decorator
+
+
+class MessageHandler:
+    __slots__ = ("name", "cog", "callback", "filter", "stats")
+
+    def __init__(self, name, cog, callback, message_filter):
+        self.name = name
+        self.cog = cog
+        self.callback = callback
+        self.filter = message_filter
+        self.stats = RequestStats()
+
+
+class MessageDispatcher:
+    """Routes messages to the handlers of every registered cog.
+
+    `log`   : Logger ; Where exceptions raised by handlers are logged.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self._routes = {ANY: [], GUILD: [], DM: [], HOME: []}
+
+    @property
+    def handlers(self):
+        return [handler for route in self._routes.values() for handler in route]
+
+    def add_cog(self, cog):
+        """Register every `message_handler` method on `cog`."""
+        for name in dir(type(cog)):
+            message_filter = getattr(getattr(type(cog), name), FILTER_ATTR, None)
+            if message_filter is None:
+                continue
+            handler = MessageHandler(
+                f"{cog.qualified_name}.{name}", cog, getattr(cog, name), message_filter
+            )
+            self._routes[message_filter.route].append(handler)
+
+    def remove_cog(self, cog):
+        """Unregister every handler belonging to `cog`."""
+        for route, handlers in self._routes.items():
+            self._routes[route] = [h for h in handlers if h.cog is not cog]
+
+    def route(self, message, is_home_guild=False) -> list:
+        """Return the handlers that want `message`."""
+        if message.guild is None:
+            candidates = self._routes[ANY] + self._routes[DM]
+        elif is_home_guild:
+            candidates = self._routes[ANY] + self._routes[GUILD] + self._routes[HOME]
+        else:
+            candidates = self._routes[ANY] + self._routes[GUILD]
+
+        from_bot = message.author.bot
+        content = message.content
+        return [
+            handler
+            for handler in candidates
+            if (handler.filter.bots or not from_bot) and handler.filter.matches(content)
+        ]
+
+    def dispatch(self, message, is_home_guild=False) -> list:
+        """Schedule every interested handler for `message`, returns the scheduled tasks."""
+        return [
+            asyncio.ensure_future(self._run(handler, message))
+            for handler in self.route(message, is_home_guild)
+        ]
+
+    async def _run(self, handler, message):
+        start = time.perf_counter()
+        error = False
+        try:
+            await handler.callback(message)
+        except Exception as e:
+            error = True
+            self.log.exception(f"Message handler {handler.name} raised", exc_info=e)
+        finally:
+            handler.stats.record((time.perf_counter() - start) * 1000, error=error)
+
+    def get_stats(self, top=None) -> dict:
+        """Return timing per handler, most total time first, optionally only the `top` few."""
+        handlers = sorted(
+            self.handlers, key=lambda h: h.stats.latency.total, reverse=True
+        )
+        if top is not None:
+            handlers = handlers[:top]
+        return {handler.name: handler.stats.to_dict() for handler in handlers}
@@ -1,21 +1,328 @@
 import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import time
 
 from bot.utils import logger as KatLogger
 from bot.utils import constants
+from bot.utils.cron import CronSchedule
+from bot.utils.metrics import RequestStats
 
 MAX_EVENT_TIMER = constants.EventManager.MAX_EVENT_TIMER
 
+# What to do when an event fires whilst a handler's previous run hasn't finished.
+SKIP = "skip"  # Drop this run.
+QUEUE = "queue"  # Run once more when the current run finishes, further runs are dropped.
+ALLOW = "allow"  # Run anyway, alongside the previous one.
+POLICIES = (SKIP, QUEUE, ALLOW)
+
+
+class Job:
+    """A periodic callback owned by the `Scheduler`.
+
+    `deadline` is in event loop time (monotonic). For interval jobs the next one is
+    always the previous deadline plus `interval`, so handler runtime never shifts
+    the schedule. Cron jobs instead track `fire_at`, the wall clock time of their
+    next run, and work out their deadline from it.
+    """
+
+    __slots__ = ("scheduler", "callback", "interval", "cron", "deadline", "fire_at", "cancelled")
+
+    def __init__(self, scheduler, callback, deadline, interval=None, cron=None, fire_at=None):
+        self.scheduler = scheduler
+        self.callback = callback
+        self.interval = interval
+        self.cron = cron
+        self.deadline = deadline
+        self.fire_at = fire_at
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop the job, it won't fire again."""
+        self.scheduler.cancel(self)
+
+    def __repr__(self):
+        return "<Job {}, next in {:.1f}s{}>".format(
+            "cron '{}' {}".format(self.cron.expression, self.cron.tz)
+            if self.cron
+            else "every {}s".format(self.interval),
+            self.deadline - self.scheduler.loop.time(),
+            ", cancelled" if self.cancelled else "",
+        )
+
+
+class Scheduler:
+    """Process-wide timer for every periodic event.
+
+    Jobs are kept in a heap ordered by deadline, with a single `loop.call_at` timer
+    armed for the earliest one. Adding a job is O(log n). Cancelling marks the job
+    and leaves it to be discarded when it reaches the top of the heap, the heap is
+    rebuilt if cancelled jobs ever make up more than half of it.
+
+    `loop`  : asyncio.AbstractEventLoop ; Loop the jobs run on.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.log = KatLogger.get_logger("Scheduler")
+
+        self._heap = []  # (deadline, seq, Job)
+        self._seq = itertools.count()  # Breaks ties between equal deadlines.
+        self._cancelled = 0
+        self._timer = None
+        self._timer_at = None
+
+        # Nobody is waiting on periodic events, so their API calls are background
+        # traffic. Jobs run in this context and tasks they create inherit it.
+        # Imported here, api imports the logger which is still loading when we are first imported.
+        from bot.utils.api import Priority, set_task_priority
+
+        self._context = contextvars.copy_context()
+        self._context.run(set_task_priority, Priority.BACKGROUND)
+
+        self.runners = {}  # event name: EventRunner
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def schedule(self, callback, interval, delay=None) -> Job:
+        """Call `callback()` every `interval` seconds, first after `delay` (default `interval`)."""
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        delay = interval if delay is None else delay
+        job = Job(self, callback, self.loop.time() + delay, interval=interval)
+        self._push(job)
+        return job
+
+    def schedule_cron(self, callback, cron: CronSchedule, first=None) -> Job:
+        """Call `callback()` at every time matching `cron`.
+
+        `first` is the wall clock time of the first run, default the next match from now.
+        A time in the past runs straight away.
+        """
+        now = time.time()
+        fire_at = cron.next_after(now) if first is None else first
+        job = Job(
+            self, callback, self.loop.time() + max(0, fire_at - now), cron=cron, fire_at=fire_at
+        )
+        self._push(job)
+        return job
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.deadline, next(self._seq), job))
+        self._arm()
+
+    def cancel(self, job: Job):
+        if job.cancelled:
+            return
+        job.cancelled = True
+        self._cancelled += 1
+        if self._cancelled > len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        self._arm()
+
+    def _arm(self):
+        """Make sure the timer is set for the earliest live job."""
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+
+        when = heap[0][0] if heap else None
+        if when == self._timer_at:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = when
+        self._timer = None if when is None else self.loop.call_at(
+            when, self._run, context=self._context
+        )
+
+    def _run(self):
+        self._timer = self._timer_at = None
+        now = self.loop.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, _, job = heapq.heappop(heap)
+            if job.cancelled:
+                self._cancelled -= 1
+                continue
+
+            if job.cron is not None:
+                # Never before the run we are about to make, the timer can go off
+                # a hair early and we mustn't match the same minute twice.
+                wall = time.time()
+                job.fire_at = job.cron.next_after(max(wall, job.fire_at))
+                job.deadline = now + max(0, job.fire_at - wall)
+            else:
+                # If the loop was blocked past one or more deadlines, fire once and
+                # carry on from the next deadline still in the future.
+                missed = int((now - deadline) // job.interval)
+                job.deadline = deadline + (missed + 1) * job.interval
+            heapq.heappush(heap, (job.deadline, next(self._seq), job))
+
+            try:
+                job.callback()
+            except Exception as e:
+                self.log.exception("Scheduled job raised", exc_info=e)
+        self._arm()
+
+
+class EventMarkers:
+    """Last run times of persisted events, kept in a JSON file across restarts.
+
+    `path`  : str   ; JSON file the markers are stored in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self._markers = json.load(f)
+        except (IOError, ValueError):
+            self._markers = {}
+
+    def get(self, name):
+        """Return when `name` last ran as a POSIX timestamp, or `None`."""
+        return self._markers.get(name)
+
+    def set(self, name, timestamp):
+        self._markers[name] = timestamp
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Written to a temporary file first so a crash can't leave half a file behind.
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self._markers, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class HandlerState:
+    """Runtime stats and overlap state of one handler of a periodic event."""
+
+    __slots__ = ("running", "queued", "overruns", "stats")
+
+    def __init__(self):
+        self.running = 0
+        self.queued = False
+        self.overruns = 0  # Times the event fired before the previous run finished.
+        self.stats = RequestStats()
+
+
+class EventRunner:
+    """Calls the listeners of a periodic event, applying its concurrency policy.
+
+    Listeners are looked up in `bot.extra_events` on every run and called directly
+    rather than through `bot.dispatch`, so each run can be timed and overlapping
+    runs of the same handler can be held back.
+
+    `bot`       : Kat   ; Bot whose listeners are called.
+    `name`      : str   ; Event name, without the `on_` prefix.
+    `policy`    : str   ; One of `POLICIES`, applied to each handler separately.
+    """
+
+    def __init__(self, bot, name, policy, log):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown event policy `{policy}`")
+        self.bot = bot
+        self.name = name
+        self.policy = policy
+        self.log = log
+        self.handlers = {}  # "Cog.on_kat_event": HandlerState
+
+    @staticmethod
+    def handler_name(listener):
+        owner = getattr(listener, "__self__", None)
+        owner = getattr(owner, "qualified_name", type(owner).__name__) if owner else None
+        return f"{owner}.{listener.__name__}" if owner else listener.__name__
+
+    def fire(self):
+        for listener in list(self.bot.extra_events.get("on_" + self.name, [])):
+            name = self.handler_name(listener)
+            state = self.handlers.get(name)
+            if state is None:
+                state = self.handlers[name] = HandlerState()
+
+            if state.running:
+                state.overruns += 1
+                if self.policy == SKIP:
+                    self.log.warning(f"Skipped `{self.name}` for {name}, still running")
+                    continue
+                if self.policy == QUEUE:
+                    state.queued = True
+                    continue
+            asyncio.ensure_future(self._run(listener, name, state))
+
+    async def _run(self, listener, name, state):
+        state.running += 1
+        start = time.perf_counter()
+        error = False
+        try:
+            await listener()
+        except Exception as e:
+            error = True
+            self.log.exception(f"{name} raised handling `{self.name}`", exc_info=e)
+        finally:
+            state.stats.record((time.perf_counter() - start) * 1000, error=error)
+            state.running -= 1
+
+        if state.queued:
+            state.queued = False
+            await self._run(listener, name, state)
+
+
+def event_stats(loop, top=None) -> dict:
+    """Return runtime stats per event handler, slowest first, optionally only the `top` few.
+
+    Keys are "event: handler", values `RequestStats.to_dict()` plus `overruns`.
+    """
+    rows = []
+    for runner in get_scheduler(loop).runners.values():
+        for name, state in runner.handlers.items():
+            stats = dict(state.stats.to_dict(), overruns=state.overruns, policy=runner.policy)
+            rows.append((f"{runner.name}: {name}", stats))
+    rows.sort(key=lambda row: row[1]["max_ms"], reverse=True)
+    return dict(rows[:top] if top is not None else rows)
+
+
+_scheduler = None
+_markers = None
+
+
+def get_scheduler(loop) -> Scheduler:
+    """Return the process-wide `Scheduler`, creating it for `loop` if needed."""
+    global _scheduler
+    if _scheduler is None or _scheduler.loop is not loop or loop.is_closed():
+        _scheduler = Scheduler(loop)
+    return _scheduler
+
+
+def get_markers() -> EventMarkers:
+    """Return the process-wide `EventMarkers`."""
+    global _markers
+    if _markers is None:
+        _markers = EventMarkers(constants.EventManager.markers_path)
+    return _markers
+
 
 class EventManager:
     """Managed event caller for Kat.
 
-    Events are registered with `create_event` and are called every `seconds`.
+    Events are registered with `create_event` and are called every `seconds`, or at
+    the times matching a cron expression. Each
+    EventManager is a handle onto the shared `Scheduler`, it only tracks which jobs
+    it owns so they can be cancelled together.
 
     event information is stored in `self._events`:
 
     ```
         self._events = {
-            "event-name": ()
+            "event-name": Job
         }
 
     """
@@ -38,38 +345,89 @@ class EventManager:
             self.log = KatLogger.get_logger("EventManager")
 
         self.bot = bot
+        self.scheduler = get_scheduler(bot.loop)
         self._events = {}
 
-    def create_event(self, name, seconds):
-        """Register an event `name` to loop every `seconds`."""
+    def create_event(self, name, schedule, timezone=None, persist=False, policy=None):
+        """Register an event `name`.
+
+        `schedule`  : int | str ; Seconds between calls, or a cron expression for wall clock aligned calls.
+        `timezone`  : str       ; Timezone of a cron expression, default `event_manager.timezone`.
+        `persist`   : bool      ; Cron only. Remember the last run across restarts, so a run
+                                  missed whilst we were down happens once on startup.
+        `policy`    : str       ; What to do if a handler is still running when the event fires
+                                  again, "skip", "queue" or "allow". Default `event_manager.policy`.
+        """
 
         if not name.startswith("kat"):
             # ensure our events start with a prefix as to not interfer with internal ones.
             name = "kat_" + name
 
+        policy = policy or constants.EventManager.policy
         if "on_" + name in self.bot.extra_events:
             # If we have already registered this event.
             self.log.warning(
                 "Tried to create event `{}` that already exists!".format(name)
             )
-        elif seconds > MAX_EVENT_TIMER:
+        elif policy not in POLICIES:
+            self.log.warning(
+                "Tried to create event `{}` with unknown policy `{}`".format(name, policy)
+            )
+        elif isinstance(schedule, str):
+            self._create_cron_event(name, schedule, timezone, persist, policy)
+        elif schedule > MAX_EVENT_TIMER:
             self.log.warning(
                 "Tried to create event `{}` with a wait period longer than {} seconds.".format(
                     name, MAX_EVENT_TIMER
                 )
             )
         else:
-
-            event = self.bot.loop.create_task(self._event(name, seconds))
-            self._events[name] = event
+            # Fired straight away, then every `schedule` seconds.
+            runner = self._add_runner(name, policy)
+            self._events[name] = self.scheduler.schedule(runner.fire, schedule, delay=0)
             self.log.info(
-                f"Registered new event `{name}` for every `{seconds}` seconds"
+                f"Registered new event `{name}` for every `{schedule}` seconds"
             )
 
+    def _add_runner(self, name, policy):
+        runner = self.scheduler.runners[name] = EventRunner(self.bot, name, policy, self.log)
+        return runner
+
+    def _create_cron_event(self, name, expression, timezone, persist, policy):
+        timezone = timezone or constants.EventManager.timezone
+        try:
+            cron = CronSchedule(expression, timezone)
+        except ValueError as e:
+            self.log.warning(f"Tried to create event `{name}` with a bad schedule: {e}")
+            return
+        if timezone and str(cron.tz) != timezone:
+            self.log.warning(f"Timezone `{timezone}` isn't available, `{name}` runs in UTC")
+
+        first = None
+        if persist:
+            markers = get_markers()
+            last_run = markers.get(name)
+            if last_run is None:
+                # Nothing to catch up on the first time we see this event.
+                markers.set(name, time.time())
+            elif cron.next_after(last_run) <= time.time():
+                first = cron.next_after(last_run)
+                self.log.info(f"Event `{name}` was missed whilst we were down, running it now")
+
+        runner = self._add_runner(name, policy)
+
+        def fire():
+            if persist:
+                get_markers().set(name, time.time())
+            runner.fire()
+
+        self._events[name] = self.scheduler.schedule_cron(fire, cron, first=first)
+        self.log.info(f"Registered new event `{name}` for `{expression}` ({cron.tz})")
+
     def create_events(self, event_map: dict):
         """Create multiple events.
 
-        `event_map`: Dict - {'event_name': int}
+        `event_map`: Dict - {'event_name': int | cron expression}
         """
 
         for k, v in event_map.items():
@@ -85,6 +443,7 @@ class EventManager:
             try:
                 self._events[name].cancel()
                 del self._events[name]
+                self.scheduler.runners.pop(name, None)
                 self.log.info("Deleted event `{}`".format(name))
 
             except Exception as e:
@@ -109,15 +468,10 @@ class EventManager:
             try:
                 self.log.debug("Attempting to delete event `{}`".format(name))
                 self._events[name].cancel()
+                self.scheduler.runners.pop(name, None)
             except Exception as e:
                 self.log.exception(
                     "Exception caught whilst trying to delete event `{}` ".format(name),
                     exc_info=e,
                 )
         del self
-
-    async def _event(self, name, seconds):
-        """Calls event and waits."""
-        while name in self._events:
-            self.bot.dispatch(name)
-            await asyncio.sleep(seconds)
@@ -133,6 +133,10 @@ class KatCog(commands.Cog):
             f" | {ctx.guild.id}] Performed {ctx.command}"
         )
 
+    async def cog_shutdown(self):
+        """Called by Kat before it disconnects. Override to flush any pending state."""
+        pass
+
     def cog_unload(self):
         self.log.info(f"Unloading {self.qualified_name}")
         self.run = False
@@ -0,0 +1,124 @@
+"""XP to level conversion.
+
+Reaching level `L` takes `k * L * (L - 1) / 2` XP in total, so each level costs
+`k` more XP than the one before. This is the integer form of the original
+`int((1 + sqrt(1 + 8 * xp / 40)) / 2)` formula and gives the same levels for
+`k = 40`, without float rounding at high XP.
+
+    curve = get_curve(40)
+    curve.level(xp)         -> int  ; level reached with `xp`
+    curve.threshold(level)  -> int  ; XP needed to reach `level`
+    curve.levels(xps)       -> list ; `level` of every XP value, vectorised when NumPy is installed
+"""
+import bisect
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _isqrt(n: int) -> int:
+    """Integer square root, for Pythons without `math.isqrt` (< 3.8)."""
+    if n <= 0:
+        return 0
+    x = 1 << ((n.bit_length() + 1) // 2)
+    while True:
+        y = (x + n // x) // 2
+        if y >= x:
+            return x
+        x = y
+
+
+isqrt = getattr(math, "isqrt", _isqrt)
+
+
+DEFAULT_K = 40
+
+# Highest level kept in a curve's threshold table, past it the closed form is used directly.
+MAX_TABLE_LEVEL = 10000
+
+
+class LevelCurve:
+    """Arithmetic level curve.
+
+    Thresholds are kept in a table that is extended as higher levels are seen, so
+    most lookups are a bisect. Levels past the end of the table are found with the
+    closed form inverse instead, then added to the table, up to `MAX_TABLE_LEVEL`.
+
+    `k` : int ; XP added to the cost of each successive level.
+    """
+
+    __slots__ = ("k", "_thresholds")
+
+    def __init__(self, k=DEFAULT_K):
+        if int(k) < 1:
+            raise ValueError("k must be a positive integer")
+        self.k = int(k)
+        # _thresholds[i] is the XP needed for level i + 1.
+        self._thresholds = [0]
+        self._extend(100)
+
+    def _threshold(self, level):
+        return self.k * level * (level - 1) // 2
+
+    def _extend(self, level):
+        table = self._thresholds
+        for lvl in range(len(table) + 1, min(level, MAX_TABLE_LEVEL) + 1):
+            table.append(self._threshold(lvl))
+
+    def level(self, xp) -> int:
+        """Return the level reached with `xp`. Members start at level 1."""
+        xp = max(0, int(xp))
+        table = self._thresholds
+        if xp < table[-1]:
+            return bisect.bisect_right(table, xp)
+
+        level = (1 + isqrt(1 + 8 * xp // self.k)) // 2
+        self._extend(level + 1)
+        return level
+
+    def levels(self, xps) -> list:
+        """Return the level reached for each value in `xps`.
+
+        Uses a single NumPy pass when NumPy is installed, for recalculating whole guilds.
+        """
+        if numpy is None or not len(xps):
+            return [self.level(xp) for xp in xps]
+
+        try:
+            quotient = numpy.maximum(numpy.asarray(xps, dtype=numpy.int64), 0) // self.k
+        except OverflowError:
+            quotient = None
+        # 1 + 8 * quotient has to fit in an int64, anything bigger takes the exact path.
+        if quotient is None or quotient.max() >= 2 ** 59:
+            return [self.level(xp) for xp in xps]
+
+        n = 1 + 8 * quotient
+        root = numpy.floor(numpy.sqrt(n)).astype(numpy.int64)
+        # float64 can't represent every int64, nudge the root onto the exact isqrt.
+        root -= root * root > n
+        root += (root + 1) * (root + 1) <= n
+        return ((1 + root) // 2).tolist()
+
+    def threshold(self, level) -> int:
+        """Return the total XP needed to reach `level`."""
+        if level < 1:
+            return 0
+        if level > MAX_TABLE_LEVEL:
+            return self._threshold(level)
+        self._extend(level)
+        return self._thresholds[level - 1]
+
+
+_curves = {}
+
+
+def get_curve(k=DEFAULT_K) -> LevelCurve:
+    """Return the shared `LevelCurve` for `k`."""
+    k = int(k)
+    curve = _curves.get(k)
+    if curve is None:
+        curve = _curves[k] = LevelCurve(k)
+    return curve
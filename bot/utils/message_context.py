@@ -0,0 +1,114 @@
+"""Per-message context shared by every listener handling the same message.
+
+A single message is seen by the prefix lookup and by every cog's `on_message`.
+`MessageContext` resolves what they need lazily and only once per message, so
+each resource costs at most one lookup however many listeners ask for it.
+
+    ctx = bot.message_context(message)
+    guild = await ctx.guild()                       # Kat API guild settings, `None` in DMs
+    member = await ctx.member(self.xp_buffer.get)   # Member from the cog's own loader
+    home = ctx.get_guild(guild_id)                  # discord.Guild from the client cache
+
+Members are remembered per loader. Listeners that change a member and rely on it
+being the copy held somewhere, like Level's XP buffer, must pass that loader;
+`ctx.member()` on its own returns a fresh read-only copy from the API.
+"""
+from collections import OrderedDict
+import asyncio
+
+from bot.utils import constants
+from bot.utils.models import Guild, Member
+
+
+class MessageContext:
+    """Lazily resolved lookups for one message.
+
+    `bot`       : Kat             ; Bot the message was received by.
+    `message`   : discord.Message ; The message.
+    """
+
+    __slots__ = ("bot", "message", "_pending", "_guilds")
+
+    def __init__(self, bot, message):
+        self.bot = bot
+        self.message = message
+        self._pending = {}  # name, or (name, loader): asyncio.Future of the resolved value
+        self._guilds = {}  # guild_id: discord.Guild
+
+    @property
+    def guild_id(self):
+        return self.message.guild.id if self.message.guild else None
+
+    @property
+    def is_home_guild(self) -> bool:
+        return self.guild_id in constants.HomeGuild.ids
+
+    async def _resolve(self, name, factory):
+        # Concurrent listeners share the first caller's lookup. Failures aren't
+        # remembered, the next caller tries again.
+        future = self._pending.get(name)
+        if future is None:
+            future = self._pending[name] = asyncio.ensure_future(factory())
+
+            def _forget_failure(f):
+                if f.cancelled() or f.exception() is not None:
+                    self._pending.pop(name, None)
+
+            future.add_done_callback(_forget_failure)
+        return await asyncio.shield(future)
+
+    async def guild(self):
+        """Return the `Guild` the message was sent in, or `None` in DMs."""
+        if self.guild_id is None:
+            return None
+        return await self._resolve(
+            "guild", lambda: Guild.get(self.guild_id, self.bot.session)
+        )
+
+    async def member(self, loader=None):
+        """Return the author's `Member` for the message's guild, or `None` in DMs.
+
+        `loader` : coroutine function taking (guild_id, user_id), defaults to `Member.get`.
+
+        Each loader is called at most once, listeners passing the same loader share its result.
+        """
+        if self.guild_id is None:
+            return None
+        if loader is None:
+            return await self._resolve(
+                "member",
+                lambda: Member.get(self.guild_id, self.message.author.id, self.bot.session),
+            )
+        return await self._resolve(
+            ("member", loader), lambda: loader(self.guild_id, self.message.author.id)
+        )
+
+    def get_guild(self, guild_id):
+        """Return the `discord.Guild` with `guild_id` from the client cache, or `None`."""
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = self.bot.get_guild(guild_id)
+        return guild
+
+
+class MessageContextCache:
+    """Most recent message contexts, keyed by message id.
+
+    `max_size`  : int   ; Contexts held before the oldest are dropped.
+    """
+
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self._contexts = OrderedDict()  # message_id: MessageContext
+
+    def get(self, bot, message) -> MessageContext:
+        """Return the context for `message`, creating it if this is the first listener to ask."""
+        context = self._contexts.get(message.id)
+        if context is None:
+            context = self._contexts[message.id] = MessageContext(bot, message)
+            while len(self._contexts) > self.max_size:
+                self._contexts.popitem(last=False)
+        return context
+
+    def __len__(self):
+        return len(self._contexts)
@@ -4,7 +4,10 @@ Retrieve information about system.
     - CPU Usage (System wide & Process specific)
     - RAM Usage (System wide & Process specific)
     - MD5 Checksums
+    - Request latency histograms
 """
+import bisect
+
 import psutil
 import hashlib
 import os
@@ -46,3 +49,66 @@ def generate_checksums(files):
     for file in files:
         checksums[file] = generate_checksum(file)
     return checksums
+
+
+class LatencyHistogram:
+    """Fixed bucket histogram of latencies in milliseconds."""
+
+    BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        # Last bucket catches everything slower than BUCKETS[-1].
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket holding the `p`th percentile."""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return float(min(bound, self.max))
+        return self.max
+
+
+class RequestStats:
+    """Request, error and byte counters along with a LatencyHistogram."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = LatencyHistogram()
+
+    def record(self, ms, nbytes=0, error=False):
+        self.requests += 1
+        self.errors += int(error)
+        self.bytes += nbytes
+        self.latency.observe(ms)
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "mean_ms": self.latency.mean,
+            "p50_ms": self.latency.percentile(50),
+            "p95_ms": self.latency.percentile(95),
+            "p99_ms": self.latency.percentile(99),
+            "max_ms": self.latency.max,
+        }
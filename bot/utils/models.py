@@ -1,21 +1,145 @@
 """Database model classes"""
+from collections import OrderedDict
+import asyncio
 import datetime
-import json
+import time
 
-from bot.utils import constants
+from bot.utils import codec, constants
+from bot.utils.api import ResponseStatusCodeException
 
 
 DEFAULT_SETTINGS = {"settings": {"prefix": constants.Bot.def_prefix}}
 
 
+class GuildCache:
+    """In-process read-through cache of guild documents from Kat API.
+
+    `ttl`       : int   ; Seconds an entry is served before being re-fetched.
+    `max_size`  : int   ; Max guilds held, least recently used are evicted first.
+
+    Documents are copied on the way in and out so callers are free to mutate
+    the `Guild` they are handed without touching the cached copy.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # guild_id: (expires_at, data)
+        self._derived = {}  # guild_id: {name: value computed from the cached data}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, guild_id, allow_stale=False):
+        """Return a copy of the cached document for `guild_id`, or `None` on a miss.
+
+        Expired entries are kept until evicted, `allow_stale` returns them anyway.
+        Used to keep serving settings whilst the API is unavailable.
+        """
+        entry = self._entries.get(guild_id)
+        if entry is None or (entry[0] < time.monotonic() and not allow_stale):
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(guild_id)
+        self.hits += 1
+        return codec.copy(entry[1])
+
+    def set(self, guild_id, data: dict):
+        """Store a copy of `data` for `guild_id`, evicting the oldest entries if full."""
+        self._entries[guild_id] = (time.monotonic() + self.ttl, codec.copy(data))
+        self._entries.move_to_end(guild_id)
+        self._derived.pop(guild_id, None)
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self._derived.pop(evicted, None)
+            self.evictions += 1
+
+    def derived(self, guild_id, name, factory):
+        """Return a value derived from the cached guild, calling `factory()` only if it isn't held.
+
+        Derived values are stored alongside the cached document and dropped whenever it
+        is replaced or evicted, so they always match the cached settings. If the guild
+        isn't cached, `factory()` is called every time.
+        """
+        if guild_id not in self._entries:
+            return factory()
+        values = self._derived.setdefault(guild_id, {})
+        if name not in values:
+            values[name] = factory()
+        return values[name]
+
+    def is_fresh(self, guild_id) -> bool:
+        """Return whether `guild_id` is cached and unexpired, without counting a hit or miss."""
+        entry = self._entries.get(guild_id)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def invalidate(self, guild_id):
+        """Drop `guild_id` from the cache if present."""
+        self._entries.pop(guild_id, None)
+        self._derived.pop(guild_id, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._derived.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+guild_cache = GuildCache(constants.ApiCache.ttl, constants.ApiCache.max_size)
+
+# Marks a lazily parsed field that hasn't been read yet.
+_UNPARSED = object()
+
+# Dirty path meaning the whole settings dict was replaced.
+ALL_SETTINGS = "*"
+
+
+def partial_settings(settings: dict, paths) -> dict:
+    """Return the parts of `settings` under each dotted path in `paths`, nested as in `settings`.
+
+    Paths covered by a dirty parent are skipped, the parent's value already includes them.
+    """
+    if ALL_SETTINGS in paths:
+        return settings
+
+    result = {}
+    included = set()
+    for path in sorted(paths, key=lambda p: p.count(".")):
+        keys = path.split(".")
+        if any(".".join(keys[:i]) in included for i in range(1, len(keys))):
+            continue
+        included.add(path)
+
+        value, target = settings, result
+        for key in keys[:-1]:
+            value = value.get(key, {})
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value.get(keys[-1])
+    return result
+
+
 class Guild:
     """Guild information from Kat API."""
 
-    __slots__ = "guild_id", "_settings"
+    __slots__ = "guild_id", "_settings", "_dirty"
 
     def __init__(self, id, _settings: dict):
         self.guild_id = id
         self._settings: dict = _settings
+        self._dirty = set()  # dotted setting keys changed since load/save
 
     @classmethod
     def from_dict(cls, data: dict):
@@ -23,31 +147,71 @@ class Guild:
 
     @classmethod
     async def get(cls, id, session):
-        data = await session.get("guilds/" + str(id))
+        data = guild_cache.get(id)
+        if data is None:
+            return await cls.fetch(id, session)
+        return cls.from_dict(data)
+
+    @classmethod
+    async def fetch(cls, id, session):
+        """Get the guild from the API, bypassing and then refreshing `guild_cache`."""
+        try:
+            data = await session.get("guilds/" + str(id))
+        except ResponseStatusCodeException as e:
+            # If the API is struggling, fall back to the last settings we saw.
+            stale = guild_cache.get(id, allow_stale=True) if e.code >= 500 else None
+            if stale is None:
+                raise
+            return cls.from_dict(stale)
+
         if data[0]:
-            return cls.from_dict(data[0])
+            data = data[0]
         else:
-            return cls.from_dict({"id": id, "settings": DEFAULT_SETTINGS})
+            data = {"id": id, "settings": codec.copy(DEFAULT_SETTINGS)}
+        guild_cache.set(id, data)
+        return cls.from_dict(data)
+
+    @classmethod
+    def warm_start(cls, ids, session):
+        """Seed `guild_cache` from the session's persisted documents. Returns how many were found."""
+        seeded = 0
+        for guild_id in ids:
+            data = session.cached("guilds/" + str(guild_id))
+            if data and data[0]:
+                guild_cache.set(guild_id, data[0])
+                seeded += 1
+        return seeded
+
+    @classmethod
+    async def prefetch(cls, ids, session, concurrency=10, refresh=False):
+        """Warm `guild_cache` for every guild in `ids` that isn't already cached.
+
+        With `refresh`, cached guilds are fetched again too. At most `concurrency`
+        guilds are fetched at once. Returns (fetched, failed).
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _fetch(guild_id):
+            async with semaphore:
+                await cls.fetch(guild_id, session)
+
+        if not refresh:
+            ids = [guild_id for guild_id in ids if not guild_cache.is_fresh(guild_id)]
+        results = await asyncio.gather(*(_fetch(i) for i in ids), return_exceptions=True)
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        return len(ids) - failed, failed
 
     @classmethod
     async def members(cls, id, session):
         data = await session.get(f"guilds/{id}/members")
         if data:
-            members = []
-            for member in data:
-                m = Member.from_dict(member)
-                members.append(m)
-            return members
+            return Member.from_list(data)
 
     @classmethod
     async def leaderboard(cls, id, session, limit=10):
         data = await session.get(f"guilds/{id}/leaderboard?limit={limit}")
         if data:
-            members = []
-            for member in data:
-                m = Member.from_dict(member)
-                members.append(m)
-            return members
+            return Member.from_list(data)
 
 
     @property
@@ -75,9 +239,27 @@ class Guild:
     def settings(self, new_settings: dict):
         """Set Guild settings as `dict`."""
         self._settings = new_settings
+        self._dirty.add(ALL_SETTINGS)
+
+    @property
+    def is_dirty(self):
+        return bool(self._dirty)
 
     async def save(self, session):
-        await session.patch("guilds/" + str(self.guild_id), self.to_dict())
+        """PATCH the settings changed since this guild was loaded. Does nothing if none were."""
+        if not self._dirty:
+            return
+
+        # Drop our entry first so nothing reads the old settings mid-PATCH,
+        # then write through once the API has accepted the new ones.
+        guild_cache.invalidate(self.guild_id)
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await session.patch("guilds/" + str(self.guild_id), self.to_patch(dirty))
+        except Exception:
+            self._dirty |= dirty
+            raise
+        guild_cache.set(self.guild_id, self.to_dict())
 
     def get_setting(self, setting_key):
         """Gets the value at `setting_key`. If it doesn't exist then returns `None`."""
@@ -99,9 +281,8 @@ class Guild:
 
         Returns `value`.
         """
-        _lst = self.settings
-        self._nested_set(_lst, setting_key.split("."), value)
-        self.settings = json.dumps(_lst)
+        self._nested_set(self._settings, setting_key.split("."), value)
+        self._dirty.add(setting_key)
         return value
 
     def _nested_set(self, dic, keys, value):
@@ -122,30 +303,50 @@ class Guild:
         )
 
     def to_dict(self):
-        # TODO: For some reason self.settings here is a str instead
-        # of a dict. I have no idea why... For now we just json.loads it.
-        return {"id": self.id, "settings": json.loads(self.settings)}
+        return {"id": self.id, "settings": self.settings}
+
+    def to_patch(self, dirty=None):
+        """Return a PATCH body with only the settings in `dirty`, default all changed settings."""
+        return {
+            "id": self.id,
+            "settings": partial_settings(self.settings, self._dirty if dirty is None else dirty),
+        }
 
 
 class User:
-    """User information from Kat API."""
+    """User information from Kat API.
+
+    The birthday is kept as the API's `YYYY-MM-DD` string and only parsed
+    into a `datetime` the first time `birthday` is read.
+    """
+
+    __slots__ = "user_id", "birthday_years", "_birthday_raw", "_birthday"
 
     def __init__(self, id, birthday="None", birthday_years=0):
         self.user_id: int = id
         self.birthday_years: int = birthday_years
-        self.birthday = (
-            datetime.datetime.strptime(birthday, "%Y-%m-%d")
-            if birthday != "None"
-            else None
-        )
+        self._birthday_raw = birthday
+        self._birthday = _UNPARSED
 
     @classmethod
     def from_dict(cls, data):
-        return cls(
-            data["id"],
-            birthday=data.get("birthday", None),
-            birthday_years=data.get("years", 0),
-        )
+        return cls(data["id"], data.get("birthday"), data.get("years", 0))
+
+    @property
+    def birthday(self):
+        if self._birthday is _UNPARSED:
+            raw = self._birthday_raw
+            self._birthday = (
+                datetime.datetime.strptime(raw, "%Y-%m-%d")
+                if raw not in (None, "None")
+                else None
+            )
+        return self._birthday
+
+    @birthday.setter
+    def birthday(self, value):
+        self._birthday_raw = None
+        self._birthday = value
 
     def to_json(self):
         return self.__repr__()
@@ -162,7 +363,7 @@ class User:
     async def get(cls, id, session):
         data = await session.get("users/" + str(id))
         if data[0]:
-            return cls.from_dict(data["data"][0])
+            return cls.from_dict(data[0])
         else:
             return cls.from_dict({"id": id})
 
@@ -173,9 +374,14 @@ class User:
         return "<User (id={})>".format(self.user_id)
 
     def __repr__(self):
+        if self._birthday is _UNPARSED:
+            # Never read, so send back exactly what we were given.
+            birthday = None if self._birthday_raw == "None" else self._birthday_raw
+        else:
+            birthday = self._birthday.strftime("%Y-%m-%d") if self._birthday else None
         return {
             "id": self.user_id,
-            "birthday": self.birthday.strftime("%Y-%m-%d") if self.birthday else None,
+            "birthday": birthday,
             "years": self.birthday_years,
         }
 
@@ -190,23 +396,34 @@ class Member:
     `_data`:dict    ;JSON dict of member-data. (for now just includes warning system data.
     """
 
-    def __init__(self, gid, uid, lvl, xp, settings=""):
+    __slots__ = "guild_id", "user_id", "_settings", "_xp", "_lvl", "_dirty"
+
+    def __init__(self, gid, uid, lvl, xp, settings=None):
         self.guild_id = gid
         self.user_id = uid
-        self._settings = settings
+        self._settings = settings if settings is not None else {}
 
-        self.xp = xp
-        self.lvl = lvl
+        self._xp = xp
+        self._lvl = lvl
+        self._dirty = set()  # changed fields, "settings." prefixed for setting keys
 
     @classmethod
     def from_dict(cls, data):
-        return cls(
-            data["gid"],
-            data["id"],
-            data.get("level", 0),
-            data.get("xp", 0),
-            data.get("settings", {}),
-        )
+        # Skips __init__, this is called for every row of whole-guild member lists.
+        member = cls.__new__(cls)
+        member.guild_id = data["gid"]
+        member.user_id = data["id"]
+        member._lvl = data.get("level", 0)
+        member._xp = data.get("xp", 0)
+        member._settings = data.get("settings") or {}
+        member._dirty = set()
+        return member
+
+    @classmethod
+    def from_list(cls, rows) -> list:
+        """Return a Member for every member dict in `rows`."""
+        from_dict = cls.from_dict
+        return [from_dict(row) for row in rows]
 
     @classmethod
     async def get(cls, gid, uid, session):
@@ -227,15 +444,48 @@ class Member:
     def set_xp(self, value):
         self.xp = value
 
+    @property
+    def xp(self):
+        return self._xp
+
+    @xp.setter
+    def xp(self, value):
+        if value != self._xp:
+            self._xp = value
+            self._dirty.add("xp")
+
+    @property
+    def lvl(self):
+        return self._lvl
+
+    @lvl.setter
+    def lvl(self, value):
+        if value != self._lvl:
+            self._lvl = value
+            self._dirty.add("level")
+
     @property
     def settings(self):
-        """Return Guild settings as a JSONDict."""
+        """Return Member settings as a JSONDict."""
         return self._settings
 
     @settings.setter
     def settings(self, new_settings: dict):
-        """Set Guild settings as `str`."""
+        """Set Member settings as `dict`."""
         self._settings = new_settings
+        self._dirty.add("settings." + ALL_SETTINGS)
+
+    @property
+    def is_dirty(self):
+        return bool(self._dirty)
+
+    def pop_changes(self) -> set:
+        """Return and clear the set of changed fields. Hand it back to `restore_changes` if the save fails."""
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def restore_changes(self, dirty: set):
+        self._dirty |= dirty
 
     def get_setting(self, setting_key):
         """Gets the value at `setting_key`. If it doesn't exist then returns `None`."""
@@ -257,9 +507,8 @@ class Member:
 
         Returns `value`.
         """
-        _lst = self.settings
-        self._nested_set(_lst, setting_key.split("."), value)
-        self.settings = json.dumps(_lst)
+        self._nested_set(self._settings, setting_key.split("."), value)
+        self._dirty.add("settings." + setting_key)
         return value
 
     def _nested_set(self, dic, keys, value):
@@ -275,7 +524,30 @@ class Member:
         return result
 
     async def save(self, session):
-        await session.patch(f"guilds/{self.guild_id}/{self.user_id}", self.__repr__())
+        """PATCH the fields changed since this member was loaded. Does nothing if none were."""
+        if not self._dirty:
+            return
+
+        dirty = self.pop_changes()
+        try:
+            await session.patch(f"guilds/{self.guild_id}/{self.user_id}", self.to_patch(dirty))
+        except Exception:
+            self.restore_changes(dirty)
+            raise
+
+    def to_patch(self, dirty=None) -> dict:
+        """Return a PATCH body with only the fields in `dirty`, default all changed fields."""
+        dirty = self._dirty if dirty is None else dirty
+        data = {"id": self.user_id, "gid": self.guild_id}
+        if "xp" in dirty:
+            data["xp"] = self.xp
+        if "level" in dirty:
+            data["level"] = self.lvl
+
+        setting_keys = {f[len("settings."):] for f in dirty if f.startswith("settings.")}
+        if setting_keys:
+            data["settings"] = partial_settings(self.settings, setting_keys)
+        return data
 
     def __str__(self):
         return "<Member (guild_id={}, user_id={}, (xp={},lvl={}))>".format(
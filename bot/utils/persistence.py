@@ -0,0 +1,111 @@
+"""SQLite backed persistence for Kat API documents.
+
+Keeps the last known copy of guild and member documents so they can be served
+whilst the API is unreachable, and queues writes made during an outage so they
+can be replayed, in order, once it comes back.
+"""
+import os
+import sqlite3
+import time
+
+from bot.utils import codec
+
+
+class PersistentStore:
+    """Local store of API documents and queued writes.
+
+    `path`  : str   ; SQLite database file, created along with its directory if needed.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Autocommit, every statement here is a single self contained write.
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "endpoint TEXT PRIMARY KEY, body TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS writes ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, method TEXT NOT NULL, "
+            "endpoint TEXT NOT NULL, body TEXT, queued_at REAL NOT NULL)"
+        )
+        self.pending = self._db.execute("SELECT COUNT(*) FROM writes").fetchone()[0]
+
+    def get(self, endpoint):
+        """Return the last stored document for `endpoint`, or `None`."""
+        row = self._db.execute(
+            "SELECT body FROM documents WHERE endpoint = ?", (endpoint,)
+        ).fetchone()
+        return codec.loads(row[0]) if row else None
+
+    def put(self, endpoint, data):
+        """Store `data` as the latest document for `endpoint`."""
+        self._db.execute(
+            "INSERT OR REPLACE INTO documents (endpoint, body, updated_at) VALUES (?, ?, ?)",
+            (endpoint, codec.dumps(data), time.time()),
+        )
+
+    def merge(self, endpoint, data: dict):
+        """Apply a PATCH body to the stored document for `endpoint`, if we have one."""
+        stored = self.get(endpoint)
+        # GETs return a list of matching documents, PATCH bodies are a single one.
+        if not stored or not isinstance(stored, list) or not isinstance(data, dict):
+            return
+        _deep_merge(stored[0], data)
+        self.put(endpoint, stored)
+
+    def queue_write(self, method, endpoint, data):
+        """Queue a write to be replayed later."""
+        self._db.execute(
+            "INSERT INTO writes (method, endpoint, body, queued_at) VALUES (?, ?, ?, ?)",
+            (method, endpoint, codec.dumps(data), time.time()),
+        )
+        self.pending += 1
+
+    def pending_writes(self) -> list:
+        """Return every queued write, oldest first, as (id, method, endpoint, data)."""
+        rows = self._db.execute(
+            "SELECT id, method, endpoint, body FROM writes ORDER BY id"
+        ).fetchall()
+        return [(i, method, endpoint, codec.loads(body)) for i, method, endpoint, body in rows]
+
+    def apply_pending(self, endpoint, document):
+        """Return `document` with the PATCHes still queued for `endpoint` applied, oldest first.
+
+        Used so a GET made before the queue is replayed doesn't return the API's older copy.
+        """
+        if not self.pending or not document or not isinstance(document, list):
+            return document
+        rows = self._db.execute(
+            "SELECT body FROM writes WHERE endpoint = ? AND method = 'PATCH' ORDER BY id",
+            (endpoint,),
+        ).fetchall()
+        if rows:
+            document = codec.copy(document)
+        for (body,) in rows:
+            data = codec.loads(body)
+            if isinstance(data, dict):
+                _deep_merge(document[0], data)
+        return document
+
+    def drop_write(self, write_id):
+        """Remove a write once it has been replayed."""
+        self._db.execute("DELETE FROM writes WHERE id = ?", (write_id,))
+        self.pending = max(0, self.pending - 1)
+
+    def close(self):
+        self._db.close()
+
+
+def _deep_merge(original: dict, new: dict):
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(original.get(key), dict):
+            _deep_merge(original[key], value)
+        else:
+            original[key] = value
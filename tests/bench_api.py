@@ -0,0 +1,80 @@
+"""Benchmark the model layer against the fake Kat API.
+
+Simulates chat traffic: every message resolves its guild's settings and awards
+a member XP, the same calls `Level.on_message` makes.
+
+    python -m tests.bench_api --messages 5000 --latency 0.02 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from bot.utils.api import APIClient
+from bot.utils.models import Guild, Member, guild_cache
+from tests.fake_api import FakeKatAPI
+
+
+async def simulate(session, guilds, members, messages, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    rng = random.Random(0)
+    failures = 0
+
+    async def message():
+        nonlocal failures
+        gid, uid = rng.randrange(1, guilds + 1), rng.randrange(1, members + 1)
+        async with semaphore:
+            try:
+                guild = await Guild.get(gid, session)
+                guild.ensure_setting("settings.level.xp_multi", 1.0)
+                member = await Member.get(gid, uid, session)
+                member.xp += 15
+                await member.save(session)
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*(message() for _ in range(messages)))
+    return failures
+
+
+async def main(args):
+    api = FakeKatAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        payload_size=args.payload_size,
+    )
+    for guild_id in range(1, args.guilds + 1):
+        api.seed_guild(guild_id, members=args.members)
+
+    session = APIClient()
+    session.root_url = await api.start()
+    guild_cache.clear()
+
+    start = time.perf_counter()
+    failures = await simulate(
+        session, args.guilds, args.members, args.messages, args.concurrency
+    )
+    elapsed = time.perf_counter() - start
+
+    await session.close()
+    await api.stop()
+
+    print(f"{args.messages} messages in {elapsed:.2f}s ({args.messages / elapsed:.0f} msg/s)")
+    print(f"{api.request_count} API requests, {api.error_count} injected errors, {failures} failed messages")
+    print(f"guild cache: {guild_cache.stats()}")
+    for route, stats in session.get_stats().items():
+        print(f"  {route:28} x{stats['requests']:<6} p50 {stats['p50_ms']:.0f}ms p95 {stats['p95_ms']:.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", default=2000, type=int)
+    parser.add_argument("--concurrency", default=50, type=int)
+    parser.add_argument("--guilds", default=5, type=int)
+    parser.add_argument("--members", default=200, type=int)
+    parser.add_argument("--latency", default=0.01, type=float)
+    parser.add_argument("--jitter", default=0.0, type=float)
+    parser.add_argument("--error-rate", default=0.0, type=float)
+    parser.add_argument("--payload-size", default=0, type=int)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,70 @@
+"""Benchmark the JSON codec against the stdlib on Kat API payloads.
+
+Compares decoding, encoding and deep copying of a guild settings document and
+a guild member listing, the payloads the bot handles most often.
+
+    python -m tests.bench_codec --members 500 --rounds 200
+"""
+import argparse
+import copy
+import json
+import random
+import timeit
+
+from bot.utils import codec
+from bot.utils.models import DEFAULT_SETTINGS
+
+
+def guild_payload():
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    settings["settings"].update(
+        {
+            "level": {"freeze": False, "xp_multi": 1.0, "ignore_chars": ["!", "?", "."]},
+            "roles": {str(i): 100000000000000000 + i for i in range(20)},
+            "welcome": {"channel": 300000000000000000, "message": "Welcome {user}!"},
+        }
+    )
+    return {"data": [{"id": 123456789012345678, "settings": settings}]}
+
+
+def members_payload(count):
+    rng = random.Random(0)
+    return {
+        "data": [
+            {
+                "gid": 123456789012345678,
+                "id": 200000000000000000 + i,
+                "xp": rng.randrange(0, 100000),
+                "level": rng.randrange(0, 70),
+                "settings": {"warnings": [], "nickname": "member {}".format(i)},
+            }
+            for i in range(count)
+        ]
+    }
+
+
+def compare(name, payload, rounds):
+    raw = json.dumps(payload)
+    cases = [
+        ("loads", lambda: json.loads(raw), lambda: codec.loads(raw)),
+        ("dumps", lambda: json.dumps(payload), lambda: codec.dumps(payload)),
+        ("copy", lambda: copy.deepcopy(payload), lambda: codec.copy(payload)),
+    ]
+    print(f"{name} ({len(raw)} bytes)")
+    for op, baseline, candidate in cases:
+        base = min(timeit.repeat(baseline, number=rounds, repeat=3)) / rounds * 1e6
+        fast = min(timeit.repeat(candidate, number=rounds, repeat=3)) / rounds * 1e6
+        print(f"  {op:6} stdlib {base:9.1f}us  {codec.NAME} {fast:9.1f}us  x{base / fast:.1f}")
+
+
+def main(args):
+    print(f"codec: {codec.NAME}")
+    compare("guild", guild_payload(), args.rounds * 10)
+    compare(f"members x{args.members}", members_payload(args.members), args.rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--members", default=500, type=int)
+    parser.add_argument("--rounds", default=200, type=int)
+    main(parser.parse_args())
@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+
+def _run_against(api, test):
+    """Run `test(session)` against `api` served on a local port."""
+    from bot.utils.api import APIClient
+    from bot.utils.models import guild_cache
+
+    async def _run():
+        url = await api.start()
+        session = APIClient()
+        session.root_url = url
+        guild_cache.clear()
+        try:
+            return await test(session)
+        finally:
+            await session.close()
+            await api.stop()
+
+    return asyncio.run(_run())
+
+
+@pytest.fixture
+def run_against():
+    """`run_against(api, test)` runs the coroutine function `test(session)` against
+    a `FakeKatAPI` served on a local port, with a fresh `APIClient` pointed at it."""
+    pytest.importorskip("aiohttp")
+    return _run_against
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces `time.monotonic` with a clock the test moves by hand, `clock.now += seconds`.
+
+    The event loop reads the same clock, so don't wait on timers whilst it is in use.
+    """
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
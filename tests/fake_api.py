@@ -0,0 +1,246 @@
+"""Stand-in Kat API for load and integration testing.
+
+Serves the endpoints used by `bot.utils.models` from in-memory storage, with
+optional injected latency, errors and padded payloads so slow or flaky API
+behaviour can be reproduced locally.
+
+Run standalone with `python -m tests.fake_api --port 8080 --latency 0.05`, then
+point `api.url` at `http://127.0.0.1:8080/`. Tests can start it in-process with
+`FakeKatAPI.start()`.
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+
+from aiohttp import web
+
+
+def _deep_merge(original: dict, new: dict):
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(original.get(key), dict):
+            _deep_merge(original[key], value)
+        else:
+            original[key] = value
+
+
+class FakeKatAPI:
+    """In-memory fake of the Kat API.
+
+    `latency`       : float ; Seconds added to every request.
+    `jitter`        : float ; Up to this many extra seconds, picked at random per request.
+    `error_rate`    : float ; Chance (0-1) of a request failing with `error_status`.
+    `error_status`  : int   ; Status code returned for injected errors.
+    `payload_size`  : int   ; Bytes of filler added to every guild and member document.
+
+    GET responses carry an ETag and honour If-None-Match with a 304. Every other
+    request is recorded in `writes` as (method, path, body) in the order received.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_status=503,
+        payload_size=0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.payload_size = payload_size
+        self._random = random.Random(seed)
+
+        self.guilds = {}  # guild_id: document
+        self.members = {}  # (guild_id, user_id): document
+        self.users = {}  # user_id: document
+
+        self.request_count = 0
+        self.error_count = 0
+        self.not_modified_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0  # most requests being handled at once
+        self.writes = []  # (method, path, body) of every non-GET request
+
+        self._runner = None
+        self.port = None
+        self.url = None
+
+        self.app = web.Application(middlewares=[self._inject_faults])
+        self.app.add_routes(
+            [
+                web.get(r"/guilds/{gid:\d+}/members", self.get_members),
+                web.patch(r"/guilds/{gid:\d+}/members", self.patch_members),
+                web.get(r"/guilds/{gid:\d+}/leaderboard", self.get_leaderboard),
+                web.get(r"/guilds/{gid:\d+}/{uid:\d+}", self.get_member),
+                web.patch(r"/guilds/{gid:\d+}/{uid:\d+}", self.patch_member),
+                web.get(r"/guilds/{gid:\d+}", self.get_guild),
+                web.patch(r"/guilds/{gid:\d+}", self.patch_guild),
+                web.get(r"/users/{uid:\d+}", self.get_user),
+                web.patch(r"/users/{uid:\d+}", self.patch_user),
+            ]
+        )
+
+    # Seeding
+    def seed_guild(self, guild_id, members=0, settings=None):
+        """Add a guild with `members` members holding random XP."""
+        self.guilds[guild_id] = {
+            "id": guild_id,
+            "settings": settings or {"settings": {"prefix": "$"}},
+        }
+        for user_id in range(1, members + 1):
+            xp = self._random.randrange(0, 100000)
+            self.members[(guild_id, user_id)] = {
+                "gid": guild_id,
+                "id": user_id,
+                "xp": xp,
+                "level": int((1 + (1 + 8 * xp / 40) ** 0.5) / 2),
+                "settings": {},
+            }
+
+    # Server lifecycle
+    async def start(self, host="127.0.0.1", port=0):
+        """Start serving, returns the root URL to use as `api.url`.
+
+        Can be called again after `stop` to simulate an outage, pass the same `port`.
+        """
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # Helpers
+    @web.middleware
+    async def _inject_faults(self, request, handler):
+        self.request_count += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await self._handle(request, handler)
+        finally:
+            self.in_flight -= 1
+
+    async def _handle(self, request, handler):
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self._random.random() < self.error_rate:
+            self.error_count += 1
+            return web.json_response({"error": "injected"}, status=self.error_status)
+
+        if request.method != "GET":
+            body = await request.json() if request.can_read_body else None
+            self.writes.append((request.method, request.path, body))
+
+        response = await handler(request)
+        if request.method == "GET" and response.status == 200:
+            etag = '"{}"'.format(hashlib.md5(response.body).hexdigest())
+            if request.headers.get("If-None-Match") == etag:
+                self.not_modified_count += 1
+                return web.Response(status=304, headers={"ETag": etag})
+            response.headers["ETag"] = etag
+        return response
+
+    def _padded(self, document):
+        if self.payload_size:
+            document = dict(document, padding="x" * self.payload_size)
+        return document
+
+    @staticmethod
+    def _respond(documents):
+        # Single documents come back as a one item list, empty when not found.
+        return web.json_response({"data": documents})
+
+    # Guilds
+    async def get_guild(self, request):
+        guild = self.guilds.get(int(request.match_info["gid"]))
+        return self._respond([self._padded(guild) if guild else {}])
+
+    async def patch_guild(self, request):
+        gid = int(request.match_info["gid"])
+        guild = self.guilds.setdefault(gid, {"id": gid, "settings": {}})
+        _deep_merge(guild, await request.json())
+        return self._respond([guild])
+
+    # Members
+    async def get_members(self, request):
+        gid = int(request.match_info["gid"])
+        return self._respond(
+            [self._padded(m) for (g, _), m in self.members.items() if g == gid]
+        )
+
+    async def patch_members(self, request):
+        gid = int(request.match_info["gid"])
+        for data in await request.json():
+            member = self.members.setdefault(
+                (gid, data["id"]), {"gid": gid, "id": data["id"], "xp": 0, "level": 0}
+            )
+            _deep_merge(member, data)
+        return self._respond([])
+
+    async def get_leaderboard(self, request):
+        gid = int(request.match_info["gid"])
+        limit = int(request.query.get("limit", 10))
+        members = [m for (g, _), m in self.members.items() if g == gid]
+        members.sort(key=lambda m: m["xp"], reverse=True)
+        return self._respond([self._padded(m) for m in members[:limit]])
+
+    async def get_member(self, request):
+        key = (int(request.match_info["gid"]), int(request.match_info["uid"]))
+        member = self.members.get(key)
+        return self._respond([self._padded(member) if member else {}])
+
+    async def patch_member(self, request):
+        gid, uid = int(request.match_info["gid"]), int(request.match_info["uid"])
+        member = self.members.setdefault(
+            (gid, uid), {"gid": gid, "id": uid, "xp": 0, "level": 0, "settings": {}}
+        )
+        _deep_merge(member, await request.json())
+        return self._respond([member])
+
+    # Users
+    async def get_user(self, request):
+        user = self.users.get(int(request.match_info["uid"]))
+        return self._respond([user or {}])
+
+    async def patch_user(self, request):
+        uid = int(request.match_info["uid"])
+        user = self.users.setdefault(uid, {"id": uid})
+        _deep_merge(user, await request.json())
+        return self._respond([user])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--latency", default=0.0, type=float)
+    parser.add_argument("--jitter", default=0.0, type=float)
+    parser.add_argument("--error-rate", default=0.0, type=float)
+    parser.add_argument("--payload-size", default=0, type=int)
+    parser.add_argument("--guilds", default=1, type=int)
+    parser.add_argument("--members", default=100, type=int)
+    args = parser.parse_args()
+
+    api = FakeKatAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        payload_size=args.payload_size,
+    )
+    for guild_id in range(1, args.guilds + 1):
+        api.seed_guild(guild_id, members=args.members)
+    web.run_app(api.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
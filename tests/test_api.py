@@ -0,0 +1,218 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot.utils import constants  # noqa: E402
+from bot.utils.api import (  # noqa: E402
+    APIClient,
+    APIUnavailableException,
+    CircuitBreaker,
+    Priority,
+    ResponseStatusCodeException,
+    TokenBucket,
+    TrafficClass,
+    route_template,
+)
+from tests.fake_api import FakeKatAPI  # noqa: E402
+
+
+def test_route_template_collapses_ids_and_query_strings():
+    assert route_template("guilds/1") == route_template("guilds/2") == "guilds/{id}"
+    assert route_template("guilds/1/2") == "guilds/{id}/{uid}"
+    assert (
+        route_template("guilds/1/leaderboard?limit=10")
+        == route_template("guilds/2/leaderboard?limit=100&offset=10")
+        == "guilds/{id}/leaderboard"
+    )
+    assert route_template("users/1/a/2/3") == "users/{id}/a/{uid}/{n}"
+
+
+def test_stats_are_recorded_per_route(run_against):
+    api = FakeKatAPI()
+    api.seed_guild(1, members=2)
+    api.seed_guild(2, members=1)
+
+    async def test(session):
+        for endpoint in ("guilds/1", "guilds/2", "guilds/1/1", "guilds/1/2", "guilds/2/1"):
+            await session.get(endpoint)
+        return {key: stats.requests for key, stats in session.stats.items()}
+
+    assert run_against(api, test) == {"GET guilds/{id}": 2, "GET guilds/{id}/{uid}": 3}
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(APIClient, "_backoff", staticmethod(lambda attempt: 0))
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow() and not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_breaker_lets_one_trial_through_when_half_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.allow()
+    assert not breaker.allow()  # Only the one trial.
+
+    # A failed trial re-opens it for another full timeout.
+    breaker.record_failure()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow() and breaker.allow()
+
+
+def test_breaker_retries_a_trial_that_never_reported_back(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_idempotent_requests_are_retried_then_trip_the_breaker(run_against, no_backoff):
+    api = FakeKatAPI(error_rate=1.0)
+    attempts = constants.ApiRetry.attempts
+    threshold = constants.ApiRetry.failure_threshold
+
+    async def test(session):
+        with pytest.raises(ResponseStatusCodeException):
+            await session.get("guilds/1")
+        assert api.request_count == attempts
+
+        # POSTs aren't safe to send twice.
+        with pytest.raises(ResponseStatusCodeException):
+            await session.post("guilds/1", {})
+        assert api.request_count == attempts + 1
+
+        while not session.breaker("guilds/1").is_open:
+            with pytest.raises(ResponseStatusCodeException):
+                await session.get("guilds/1")
+        sent = api.request_count
+        assert sent >= threshold
+
+        # Open, so it fails fast without reaching the API.
+        with pytest.raises(APIUnavailableException):
+            await session.get("guilds/2")
+        assert api.request_count == sent
+
+        # Other endpoint families have their own breaker.
+        with pytest.raises(ResponseStatusCodeException) as e:
+            await session.get("users/1")
+        assert not isinstance(e.value, APIUnavailableException)
+
+    run_against(api, test)
+
+
+def test_client_errors_count_as_success(run_against, no_backoff):
+    api = FakeKatAPI(error_rate=1.0, error_status=404)
+    threshold = constants.ApiRetry.failure_threshold
+
+    async def test(session):
+        for _ in range(threshold + 1):
+            with pytest.raises(ResponseStatusCodeException) as e:
+                await session.get("guilds/1")
+            assert e.value.code == 404
+        assert not session.breaker("guilds/1").is_open
+
+    run_against(api, test)
+    # 4xx aren't retried either.
+    assert api.request_count == threshold + 1
+
+
+def test_queue_depth_is_reported_per_priority(run_against):
+    api = FakeKatAPI(latency=0.1)
+    api.seed_guild(1, members=3)
+
+    async def test(session):
+        session._traffic[Priority.INTERACTIVE] = TrafficClass(concurrency=1, rate=0, burst=1)
+        requests = [
+            asyncio.ensure_future(session.get(f"guilds/1/{uid}")) for uid in range(1, 4)
+        ]
+        await asyncio.sleep(0.05)
+        during = session.get_queue_depths()
+        await asyncio.gather(*requests)
+        return during, session.get_queue_depths()
+
+    during, after = run_against(api, test)
+    assert during == {Priority.INTERACTIVE: 2}
+    assert after == {Priority.INTERACTIVE: 0}
+
+
+def test_token_bucket_refills_at_its_rate(clock):
+    async def test():
+        bucket = TokenBucket(rate=2, burst=2)
+        await bucket.acquire()
+        await bucket.acquire()
+
+        waiter = asyncio.ensure_future(bucket.acquire())
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert not waiter.done()
+
+        clock.now += 0.5
+        await asyncio.wait_for(waiter, 1)
+        assert bucket.tokens == 0
+
+        # Refills stop at the burst size however long it has been idle.
+        clock.now += 60
+        for _ in range(2):
+            await bucket.acquire()
+        assert bucket.tokens == 0
+
+    asyncio.run(test())
+
+
+def test_saturated_background_does_not_delay_interactive(run_against):
+    api = FakeKatAPI(latency=0.2)
+    api.seed_guild(1, members=5)
+
+    async def test(session):
+        # One at a time, one a second, so every background request after the first queues.
+        session._traffic[Priority.BACKGROUND] = TrafficClass(concurrency=1, rate=1, burst=1)
+        loop = asyncio.get_event_loop()
+        with session.background():
+            queued = [
+                asyncio.ensure_future(session.get(f"guilds/1/{uid}")) for uid in range(1, 6)
+            ]
+        await asyncio.sleep(0.05)
+
+        started = loop.time()
+        await session.get("guilds/1")
+        took = loop.time() - started
+        waiting = session.get_queue_depths()[Priority.BACKGROUND]
+        for request in queued:
+            request.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        return took, waiting
+
+    took, waiting = run_against(api, test)
+    assert waiting == 4
+    assert took < 0.4
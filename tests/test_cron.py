@@ -0,0 +1,74 @@
+import datetime
+
+import pytest
+
+from bot.utils.cron import CronSchedule, get_timezone
+
+
+def ts(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def test_next_after():
+    hourly = CronSchedule("0 * * * *")
+    assert hourly.next_after(ts(2024, 1, 1, 10, 0)) == ts(2024, 1, 1, 11, 0)
+    assert hourly.next_after(ts(2024, 1, 1, 10, 59, 59)) == ts(2024, 1, 1, 11, 0)
+
+    every_five = CronSchedule("*/5 * * * *")
+    assert every_five.next_after(ts(2024, 1, 1, 23, 58)) == ts(2024, 1, 2, 0, 0)
+
+    # 2024-01-01 is a Monday.
+    monday = CronSchedule("0 0 * * 1")
+    assert monday.next_after(ts(2024, 1, 1, 0, 0)) == ts(2024, 1, 8, 0, 0)
+    assert CronSchedule("0 0 * * 7").next_after(ts(2024, 1, 1)) == ts(2024, 1, 7)
+
+    leap = CronSchedule("30 12 29 2 *")
+    assert leap.next_after(ts(2024, 3, 1)) == ts(2028, 2, 29, 12, 30)
+
+    # Either day field may match once both are restricted.
+    either = CronSchedule("0 0 15 * 1")
+    assert either.next_after(ts(2024, 1, 9)) == ts(2024, 1, 15)
+    assert either.next_after(ts(2024, 1, 15)) == ts(2024, 1, 22)
+
+
+def test_lists_ranges_and_steps():
+    cron = CronSchedule("0,30 9-17/4 * 1-3 *")
+    assert sorted(cron.minutes) == [0, 30]
+    assert sorted(cron.hours) == [9, 13, 17]
+    assert sorted(cron.months) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "*/0 * * * *", "0 0 30 2 *"])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression).next_after(ts(2024, 1, 1))
+
+
+def test_unknown_timezone_falls_back_to_utc():
+    tz, fell_back = get_timezone("Not/AZone")
+    assert tz is datetime.timezone.utc and fell_back
+    assert get_timezone("UTC") == (datetime.timezone.utc, False)
+
+
+def test_local_time_across_dst_changes():
+    tz, fell_back = get_timezone("Europe/London")
+    if fell_back:
+        pytest.skip("No timezone database available")
+
+    # Clocks go forward at 01:00 UTC on 2024-03-31, 09:00 local moves from 09:00 to 08:00 UTC.
+    nine = CronSchedule("0 9 * * *", timezone="Europe/London")
+    runs, now = [], ts(2024, 3, 29, 12)
+    for _ in range(4):
+        now = nine.next_after(now)
+        runs.append(now)
+    assert runs == [ts(2024, 3, 30, 9), ts(2024, 3, 31, 8), ts(2024, 4, 1, 8), ts(2024, 4, 2, 8)]
+
+    # 01:30 doesn't exist on the spring day, it runs at the same instant as 02:30 BST, once.
+    half_one = CronSchedule("30 1 * * *", timezone="Europe/London")
+    assert half_one.next_after(ts(2024, 3, 30, 12)) == ts(2024, 3, 31, 1, 30)
+    assert half_one.next_after(ts(2024, 3, 31, 1, 30)) == ts(2024, 4, 1, 0, 30)
+
+    # 01:30 happens twice on the autumn day (BST then GMT), it only runs the first time.
+    first = half_one.next_after(ts(2024, 10, 26, 12))
+    assert first == ts(2024, 10, 27, 0, 30)
+    assert half_one.next_after(first) == ts(2024, 10, 28, 1, 30)
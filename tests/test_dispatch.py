@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import types
+
+import pytest
+
+from bot.utils.dispatch import MessageDispatcher, message_handler
+
+
+class FakeCog:
+    qualified_name = "Fake"
+
+    def __init__(self):
+        self.seen = []
+
+    @message_handler(guild_only=True)
+    async def guild_messages(self, message):
+        self.seen.append(("guild", message.content))
+
+    @message_handler(dm_only=True, prefix="RANT ")
+    async def rants(self, message):
+        self.seen.append(("rant", message.content))
+
+    @message_handler(home_guild_only=True, pattern=r"(?i)gorl")
+    async def home(self, message):
+        self.seen.append(("home", message.content))
+
+    @message_handler(pattern="boom")
+    async def broken(self, message):
+        raise RuntimeError("boom")
+
+
+def message(content, guild=True, bot=False):
+    return types.SimpleNamespace(
+        content=content,
+        guild=types.SimpleNamespace(id=1) if guild else None,
+        author=types.SimpleNamespace(bot=bot),
+    )
+
+
+def test_messages_are_routed_by_filter():
+    cog = FakeCog()
+    dispatcher = MessageDispatcher(logging.getLogger("test"))
+    dispatcher.add_cog(cog)
+
+    async def run():
+        for msg, home in [
+            (message("hello"), False),
+            (message("GORL"), True),
+            (message("gorl"), False),
+            (message("RANT hi", guild=False), False),
+            (message("hi", guild=False), False),
+            (message("hello", bot=True), False),
+            (message("boom", guild=False), False),
+        ]:
+            await asyncio.gather(*dispatcher.dispatch(msg, home))
+
+    asyncio.run(run())
+    assert cog.seen == [
+        ("guild", "hello"),
+        ("guild", "GORL"),
+        ("home", "GORL"),
+        ("guild", "gorl"),
+        ("rant", "RANT hi"),
+    ]
+    stats = dispatcher.get_stats()
+    assert stats["Fake.guild_messages"]["requests"] == 3
+    assert stats["Fake.broken"]["errors"] == 1
+
+    dispatcher.remove_cog(cog)
+    assert dispatcher.handlers == []
+
+
+def test_conflicting_filters_are_rejected():
+    with pytest.raises(ValueError):
+        message_handler(guild_only=True, dm_only=True)
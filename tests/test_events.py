@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+
+import pytest
+
+from bot.utils.api import Priority, _current_priority
+from bot.utils.events import Scheduler
+
+
+class FakeBot:
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.extra_events = {}
+
+
+class FakeTimer:
+    def __init__(self, when, callback, context):
+        self.when = when
+        self.callback = callback
+        self.context = context
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Just enough of an event loop for `Scheduler`, on a clock the test moves by hand."""
+
+    def __init__(self, lateness=0.0):
+        self.now = 0.0
+        self.lateness = lateness  # How late every timer goes off.
+        self.timer = None
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback, context=None):
+        self.timer = FakeTimer(when, callback, context)
+        return self.timer
+
+    def advance_to(self, until):
+        while self.timer is not None and self.timer.when + self.lateness <= until:
+            timer, self.timer = self.timer, None
+            if timer.cancelled:
+                continue
+            self.now = max(self.now, timer.when + self.lateness)
+            timer.context.run(timer.callback)
+        self.now = max(self.now, until)
+
+
+def test_jobs_fire_on_a_fixed_grid_without_drift():
+    loop = FakeLoop(lateness=0.004)
+    scheduler = Scheduler(loop)
+    fired, deadlines = [], []
+
+    def slow():
+        fired.append(loop.now)
+        deadlines.append(job.deadline)
+        loop.now += 0.015  # Handler runtime mustn't push later runs back.
+
+    job = scheduler.schedule(slow, 0.05)
+    loop.advance_to(0.52)
+
+    assert len(fired) == 10
+    assert deadlines == pytest.approx([0.05 * (i + 2) for i in range(10)])
+    # Every run is as late as the timer, the error doesn't accumulate.
+    assert fired == pytest.approx([0.05 * (i + 1) + 0.004 for i in range(10)])
+
+
+def test_blocked_loop_fires_missed_jobs_once():
+    loop = FakeLoop()
+    scheduler = Scheduler(loop)
+    fired = []
+    job = scheduler.schedule(lambda: fired.append(loop.now), 0.05)
+
+    loop.advance_to(0.05)
+    # Blocked past two deadlines, fire once and keep to the grid.
+    loop.now = 0.17
+    loop.advance_to(0.17)
+    assert fired == pytest.approx([0.05, 0.17])
+    assert job.deadline == pytest.approx(0.2)
+
+
+def test_cancel_and_background_priority():
+    async def run():
+        loop = asyncio.get_event_loop()
+        scheduler = Scheduler(loop)
+        seen = []
+        jobs = [
+            scheduler.schedule(lambda i=i: seen.append((i, _current_priority.get())), 0.02)
+            for i in range(100)
+        ]
+        for job in jobs[1:]:
+            job.cancel()
+        assert len(scheduler) == 1
+        await asyncio.sleep(0.05)
+        jobs[0].cancel()
+        await asyncio.sleep(0.05)
+        return seen, len(scheduler)
+
+    seen, remaining = asyncio.run(run())
+    assert remaining == 0
+    assert seen and {i for i, _ in seen} == {0}
+    assert {priority for _, priority in seen} == {Priority.BACKGROUND}
+
+
+def test_missed_persisted_event_runs_once(tmp_path, monkeypatch):
+    from bot.utils import events
+
+    markers = events.EventMarkers(str(tmp_path / "markers.json"))
+    # Last ran two days ago, so at least one daily run was missed.
+    markers.set("kat_daily", time.time() - 2 * 86400)
+    monkeypatch.setattr(events, "_markers", events.EventMarkers(markers.path))
+
+    async def run():
+        fake_bot = FakeBot()
+        manager = events.EventManager(fake_bot)
+        manager.create_event("daily", "0 0 * * *", persist=True)
+        runs = []
+
+        async def on_kat_daily():
+            runs.append(1)
+
+        fake_bot.extra_events["on_kat_daily"] = [on_kat_daily]
+        await asyncio.sleep(0.05)
+        manager.destroy()
+        return runs
+
+    assert asyncio.run(run()) == [1]
+    assert time.time() - events.EventMarkers(markers.path).get("kat_daily") < 5
+
+
+@pytest.mark.parametrize("policy, runs", [("skip", 1), ("queue", 2), ("allow", 3)])
+def test_overlapping_runs_follow_the_policy(policy, runs):
+    from bot.utils import events
+
+    async def run():
+        fake_bot = FakeBot()
+        release = asyncio.Event()
+        started = []
+
+        async def on_kat_slow():
+            started.append(1)
+            await release.wait()
+
+        fake_bot.extra_events["on_kat_slow"] = [on_kat_slow]
+        runner = events.EventRunner(fake_bot, "kat_slow", policy, logging.getLogger(__name__))
+        for _ in range(3):  # Fires twice more whilst the first run is going.
+            runner.fire()
+            await asyncio.sleep(0)
+        state = runner.handlers["on_kat_slow"]
+        release.set()
+        while state.running or state.queued:
+            await asyncio.sleep(0)
+        return len(started), state
+
+    started, state = asyncio.run(run())
+    assert started == runs
+    assert state.overruns == 2
+    assert state.stats.requests == runs
+
+
+def test_event_stats_are_reported_per_handler():
+    from bot.utils import events
+
+    async def run():
+        fake_bot = FakeBot()
+        manager = events.EventManager(fake_bot)
+        manager.create_event("quick", 60, policy="queue")
+        runs = []
+
+        async def on_kat_quick():
+            runs.append(1)
+
+        fake_bot.extra_events["on_kat_quick"] = [on_kat_quick]
+        events.get_scheduler(fake_bot.loop).runners["kat_quick"].fire()
+        await asyncio.sleep(0)
+        stats = events.event_stats(fake_bot.loop)
+        manager.destroy()
+        return runs, stats
+
+    runs, stats = asyncio.run(run())
+    assert runs == [1]
+    row = stats["kat_quick: on_kat_quick"]
+    assert (row["requests"], row["overruns"], row["policy"]) == (1, 0, "queue")
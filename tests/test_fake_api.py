@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot.utils.api import ResponseStatusCodeException  # noqa: E402
+from bot.utils.models import Guild, Member  # noqa: E402
+from tests.fake_api import FakeKatAPI  # noqa: E402
+
+
+def test_guild_round_trip(run_against):
+    api = FakeKatAPI()
+    api.seed_guild(1, settings={"settings": {"prefix": "$", "level": {"freeze": False}}})
+
+    async def test(session):
+        guild = await Guild.get(1, session)
+        assert guild.prefix == "$"
+        guild.prefix = "!"
+        await guild.save(session)
+
+    run_against(api, test)
+    assert api.guilds[1]["settings"] == {"settings": {"prefix": "!", "level": {"freeze": False}}}
+
+
+def test_members_and_leaderboard(run_against):
+    api = FakeKatAPI(seed=1)
+    api.seed_guild(1, members=25)
+
+    async def test(session):
+        member = await Member.get(1, 5, session)
+        member.xp += 10
+        await member.save(session)
+
+        members = await Guild.members(1, session)
+        leaders = await Guild.leaderboard(1, session, limit=5)
+        return member, members, leaders
+
+    member, members, leaders = run_against(api, test)
+    assert api.members[(1, 5)]["xp"] == member.xp
+    assert len(members) == 25
+    assert [m.xp for m in leaders] == sorted((m.xp for m in members), reverse=True)[:5]
+
+
+def test_injected_errors_are_raised_after_retries(run_against):
+    api = FakeKatAPI(error_rate=1.0)
+
+    async def test(session):
+        with pytest.raises(ResponseStatusCodeException):
+            await session.get("guilds/1")
+
+    run_against(api, test)
+    assert api.request_count > 1
+
+
+def test_conditional_get_reuses_body_on_not_modified(run_against):
+    api = FakeKatAPI()
+    api.seed_guild(1)
+
+    async def test(session):
+        first = await session.get("guilds/1")
+        second = await session.get("guilds/1")
+        api.guilds[1]["settings"]["settings"]["prefix"] = "!"
+        third = await session.get("guilds/1")
+        return first, second, third
+
+    first, second, third = run_against(api, test)
+    assert first == second
+    assert third[0]["settings"]["settings"]["prefix"] == "!"
+    assert api.not_modified_count == 1
+
+
+def test_concurrent_gets_are_coalesced(run_against):
+    api = FakeKatAPI(latency=0.1)
+    api.seed_guild(1)
+
+    async def test(session):
+        waiters = [asyncio.ensure_future(session.get("guilds/1")) for _ in range(5)]
+        await asyncio.sleep(0.02)
+        waiters[0].cancel()
+        results = await asyncio.gather(*waiters[1:])
+        assert waiters[0].cancelled()
+        return results
+
+    results = run_against(api, test)
+    assert api.request_count == 1
+    assert all(result == results[0] for result in results)
+    assert len({id(result) for result in results}) == len(results)
+    results[0][0]["settings"]["settings"]["prefix"] = "!"
+    assert results[1][0]["settings"]["settings"]["prefix"] == "$"
+
+
+def test_not_modified_bodies_are_private_and_large_ones_are_not_kept(run_against):
+    api = FakeKatAPI(payload_size=1000)
+    api.seed_guild(1, members=100)
+
+    async def test(session):
+        first = await session.request("GET", "guilds/1")
+        first[0]["settings"]["settings"]["prefix"] = "!"
+        second = await session.request("GET", "guilds/1")
+        third = await session.request("GET", "guilds/1")
+        second[0]["id"] = 2
+
+        await session.get("guilds/1/members")
+        await session.get("guilds/1/members")
+        return second, third, session.not_modified
+
+    second, third, not_modified = run_against(api, test)
+    assert second[0]["settings"]["settings"]["prefix"] == "$"
+    assert third[0]["id"] == 1
+    # Only the guild was sent conditionally, the ~100KB member list wasn't remembered.
+    assert not_modified == api.not_modified_count == 2
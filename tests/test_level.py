@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import types
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot.utils.cogs.level import (  # noqa: E402
+    Leaderboard,
+    RankIndex,
+    XPBuffer,
+    XPCooldown,
+    compile_prefixes,
+    recalculate_levels,
+)
+from bot.utils.level_curve import get_curve  # noqa: E402
+from bot.utils.models import GuildCache  # noqa: E402
+from tests.fake_api import FakeKatAPI  # noqa: E402
+
+# Cogs import the logger, which api has to have loaded first.
+from bot.cogs.level import Level  # noqa: E402
+
+
+def test_leaderboard_is_updated_in_memory(run_against):
+    api = FakeKatAPI(seed=3)
+    api.seed_guild(1, members=50)
+
+    async def test(session):
+        buffer = XPBuffer(session)
+        leaderboard = Leaderboard(session, size=20, buffer=buffer)
+        first, _, pages = await leaderboard.page(1, per_page=10)
+        requests = api.request_count
+
+        member = await buffer.get(1, 7)
+        member.xp = 10 ** 7
+        buffer.mark_dirty(member)
+        leaderboard.update(member)
+        board = await leaderboard.get(1)
+        assert api.request_count == requests + 1  # Only the member was fetched.
+
+        # Unflushed XP survives a refresh from the API.
+        leaderboard.refresh_interval = 0
+        refreshed = await leaderboard.get(1)
+        return first, pages, board, refreshed
+
+    first, pages, board, refreshed = run_against(api, test)
+    assert pages == 2
+    assert [row[0] for row in first] == list(range(1, 11))
+    assert board[0][:2] == (7, 10 ** 7)
+    assert len(board) == 20
+    assert [xp for _, xp, _ in board] == sorted((xp for _, xp, _ in board), reverse=True)
+    assert refreshed[0][0] == 7
+
+
+def test_rank_index_tracks_awarded_xp(run_against):
+    api = FakeKatAPI(seed=4)
+    api.seed_guild(1, members=30)
+
+    async def test(session):
+        buffer = XPBuffer(session)
+        ranks = RankIndex(session)
+        member = await buffer.get(1, 3)
+        before = await ranks.rank(member)
+        requests = api.request_count
+
+        member.xp = 10 ** 7
+        ranks.update(member)
+        after = await ranks.rank(member)
+        assert api.request_count == requests
+        return before, after
+
+    before, after = run_against(api, test)
+    xps = sorted((m["xp"] for m in api.members.values()), reverse=True)
+    assert before == (xps.index(api.members[(1, 3)]["xp"]) + 1, 30)
+    assert after == (1, 30)
+
+
+def test_rank_index_refreshes_and_is_bounded(run_against):
+    api = FakeKatAPI(seed=6)
+    for guild_id in (1, 2, 3):
+        api.seed_guild(guild_id, members=10)
+
+    async def test(session):
+        buffer = XPBuffer(session)
+        ranks = RankIndex(session, refresh_interval=300, max_guilds=2, buffer=buffer)
+        member = await buffer.get(1, 1)
+        await ranks.rank(member)
+
+        # Changed elsewhere, only seen once the index is rebuilt.
+        api.members[(1, 2)]["xp"] = 10 ** 7
+        member.xp = 10 ** 6
+        buffer.mark_dirty(member)  # Unflushed XP survives the rebuild.
+        cached = await ranks.rank(member)
+        ranks.refresh_interval = 0
+        refreshed = await ranks.rank(member)
+
+        for guild_id in (2, 3):
+            await ranks.rank(await buffer.get(guild_id, 1))
+        return cached, refreshed, len(ranks), sorted(ranks._sorted)
+
+    cached, refreshed, size, guilds = run_against(api, test)
+    assert cached == (1, 10)
+    assert refreshed == (2, 10)
+    assert (size, guilds) == (2, [2, 3])
+
+
+def test_xp_cooldown_bucket_and_expiry():
+    cooldown = XPCooldown(per=10, burst=2)
+    assert [cooldown.allow(1, 1, now=0) for _ in range(3)] == [True, True, False]
+    assert cooldown.allow(1, 2, now=0)  # Buckets are per member.
+    assert not cooldown.allow(1, 1, now=5)
+    assert cooldown.allow(1, 1, now=10.5)
+
+    # Idle members are dropped once their bucket would be full again.
+    assert cooldown.allow(2, 1, now=31)
+    assert len(cooldown) == 1
+
+
+def test_recalculate_levels_writes_only_changed_members(run_against):
+    api = FakeKatAPI(seed=5)
+    api.seed_guild(1, members=40)
+
+    async def test(session):
+        unchanged = await recalculate_levels(session, 1, get_curve(40))
+        dry_run = await recalculate_levels(session, 1, get_curve(20))
+        requests = api.request_count
+        applied = await recalculate_levels(session, 1, get_curve(20), apply=True)
+        return unchanged, dry_run, applied, api.request_count - requests
+
+    unchanged, dry_run, applied, requests = run_against(api, test)
+    assert unchanged == (40, [], 0, 0)
+    total, changes, written, failed = applied
+    assert dry_run[1] == changes and len(changes) > 0
+    assert (written, failed) == (len(changes), 0)
+    assert requests == 1 + len(changes)
+    assert all(api.members[(1, uid)]["level"] == new for uid, _, new in changes)
+
+
+def test_ignore_prefixes_are_compiled_and_cached_with_the_guild():
+    assert compile_prefixes(["!", "", "http", "!"]) == ("!", "http")
+    assert compile_prefixes("~") == ("~",)
+    assert compile_prefixes(None) == ()
+    assert not "hello".startswith(compile_prefixes([""]))
+
+    cache = GuildCache(ttl=60, max_size=10)
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return compile_prefixes(["?"])
+
+    assert cache.derived(1, "prefixes", factory) == ("?",)  # Not cached, not stored.
+    cache.set(1, {"id": 1, "settings": {}})
+    cache.derived(1, "prefixes", factory)
+    cache.derived(1, "prefixes", factory)
+    assert len(calls) == 2
+
+    cache.set(1, {"id": 1, "settings": {"changed": True}})
+    cache.derived(1, "prefixes", factory)
+    assert len(calls) == 3
+
+
+def test_xp_buffer_flushes_once_full(run_against):
+    api = FakeKatAPI(seed=7)
+    api.seed_guild(1, members=5)
+
+    async def test(session):
+        buffer = XPBuffer(session, flush_size=3)
+        due = []
+        for user_id in (1, 2, 3):
+            member = await buffer.get(1, user_id)
+            member.xp += 100
+            due.append(buffer.mark_dirty(member))
+        assert due == [False, False, True]
+        assert await buffer.flush() == (3, 0)
+        assert buffer.dirty_count == 0
+        assert await buffer.flush() == (0, 0)
+
+    before = {uid: api.members[(1, uid)]["xp"] for uid in (1, 2, 3)}
+    run_against(api, test)
+    assert sorted(path for _, path, _ in api.writes) == ["/guilds/1/1", "/guilds/1/2", "/guilds/1/3"]
+    assert all(api.members[(1, uid)]["xp"] == before[uid] + 100 for uid in (1, 2, 3))
+
+
+def test_xp_buffer_writes_each_guild_in_one_bulk_request(run_against):
+    api = FakeKatAPI(seed=8)
+    api.seed_guild(1, members=3)
+    api.seed_guild(2, members=3)
+
+    async def test(session):
+        buffer = XPBuffer(session, bulk_endpoint="guilds/{gid}/members")
+        for guild_id in (1, 2):
+            for user_id in (1, 2, 3):
+                member = await buffer.get(guild_id, user_id)
+                member.xp = 10 ** 6 + user_id
+                buffer.mark_dirty(member)
+        return await buffer.flush()
+
+    assert run_against(api, test) == (6, 0)
+    assert sorted(path for _, path, _ in api.writes) == ["/guilds/1/members", "/guilds/2/members"]
+    assert api.members[(2, 3)]["xp"] == 10 ** 6 + 3
+
+
+def test_xp_buffer_keeps_failed_members_and_backs_off(run_against):
+    api = FakeKatAPI(seed=9)
+    api.seed_guild(1, members=3)
+
+    async def test(session):
+        buffer = XPBuffer(session, flush_size=2, retry_delay=60)
+        members = [await buffer.get(1, user_id) for user_id in (1, 2)]
+        third = await buffer.get(1, 3)
+        for member in members:
+            member.xp = 12345
+            buffer.mark_dirty(member)
+
+        api.error_rate = 1.0
+        assert await buffer.flush() == (0, 2)
+        assert buffer.dirty_count == 2
+        # Still full, but no early flush is asked for whilst backing off.
+        third.xp = 12345
+        assert [buffer.mark_dirty(m) for m in (*members, third)] == [False] * 3
+
+        api.error_rate = 0.0
+        assert await buffer.flush() == (3, 0)
+        assert buffer.mark_dirty(third) is False  # Backoff is cleared, but one isn't full.
+
+    run_against(api, test)
+    assert all(api.members[(1, uid)]["xp"] == 12345 for uid in (1, 2, 3))
+
+
+def test_level_starts_one_early_flush_and_drains_on_shutdown(run_against):
+    api = FakeKatAPI(latency=0.05, seed=10)
+    api.seed_guild(1, members=5)
+
+    async def test(session):
+        loop = asyncio.get_event_loop()
+        started = []
+
+        def create_task(coro):
+            started.append(loop.create_task(coro))
+            return started[-1]
+
+        cog = Level.__new__(Level)
+        cog.bot = types.SimpleNamespace(
+            session=session, loop=types.SimpleNamespace(create_task=create_task)
+        )
+        cog.log = logging.getLogger(__name__)
+        cog.xp_buffer = XPBuffer(session, flush_size=1)
+        cog.leaderboards = Leaderboard(session)
+        cog.ranks = RankIndex(session)
+        cog._flush_task = None
+
+        guild = types.SimpleNamespace(id=1, ensure_setting=lambda key, default: default)
+        async def send(*args, **kwargs):
+            pass
+
+        message = types.SimpleNamespace(
+            clean_content="hello there", channel=types.SimpleNamespace(send=send)
+        )
+        members = [await cog.xp_buffer.get(1, user_id) for user_id in range(1, 6)]
+        for member in members:
+            await cog.give_xp(message, guild, member)
+        early = cog._flush_task
+
+        await cog.cog_shutdown()
+        dirty = cog.xp_buffer.dirty_count
+        await early
+        return dirty, started
+
+    dirty, started = run_against(api, test)
+    # The buffer was full on every award, but the first flush was still running.
+    assert len(started) == 1
+    assert dirty == 0
+    assert len(api.writes) == 5
+
+
+@pytest.mark.parametrize("args", [("abc",), ("1", "aply")])
+def test_recalc_replies_with_usage_for_bad_arguments(args):
+    sent = []
+
+    async def send(content):
+        sent.append(content)
+
+    async def test():
+        cog = Level.__new__(Level)
+        flushed = []
+        cog.flush_xp = lambda: flushed.append(True)
+        await Level.recalc.callback(cog, types.SimpleNamespace(send=send), *args)
+        return flushed
+
+    assert asyncio.run(test()) == []
+    assert len(sent) == 1 and sent[0].startswith("Usage:")
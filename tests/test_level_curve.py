@@ -0,0 +1,78 @@
+import math
+import random
+
+import pytest
+
+from bot.utils import level_curve
+from bot.utils.level_curve import LevelCurve, get_curve
+
+
+def old_level(xp):
+    return int((1 + math.sqrt(1 + 8 * (xp) / 40)) / 2)
+
+
+def test_matches_original_formula():
+    curve = LevelCurve()
+    rng = random.Random(0)
+    samples = list(range(0, 50000)) + [rng.randrange(0, 10 ** 9) for _ in range(20000)]
+    for xp in samples:
+        assert curve.level(xp) == old_level(xp), xp
+
+
+def test_thresholds_are_exact_boundaries():
+    curve = LevelCurve(40)
+    for level in range(1, 3000):
+        threshold = curve.threshold(level)
+        assert curve.level(threshold) == level
+        assert curve.level(threshold - 1) == level - 1 or threshold == 0
+
+
+def test_levels_past_one_thousand():
+    curve = get_curve(40)
+    xp = curve.threshold(5000) + 1
+    assert curve.level(xp) == 5000
+    assert curve.threshold(5001) > xp
+    # A fresh curve gets there through the closed form rather than the table.
+    assert LevelCurve(40).level(xp) == 5000
+
+
+def test_isqrt_fallback():
+    for n in list(range(10000)) + [10 ** 30 + 7, 2 ** 127]:
+        root = level_curve._isqrt(n)
+        assert root ** 2 <= n < (root + 1) ** 2
+
+
+def test_invalid_k():
+    with pytest.raises(ValueError):
+        LevelCurve(0)
+
+
+
+def test_huge_xp_does_not_grow_the_table():
+    curve = LevelCurve(1)
+    xp = 2 ** 62
+    level = curve.level(xp)
+    assert curve.threshold(level) <= xp < curve.threshold(level + 1)
+    assert len(curve._thresholds) <= level_curve.MAX_TABLE_LEVEL
+
+
+def test_vectorised_levels_match_level():
+    pytest.importorskip("numpy")
+    assert level_curve.numpy is not None
+
+    rng = random.Random(19)
+    for k in (1, 20, 40, 977):
+        curve = LevelCurve(k)
+        xps = [rng.randrange(0, 10 ** 6) for _ in range(2000)]
+        # Large enough for sqrt in float64 to be off by one without the correction.
+        xps += [rng.randrange(0, 2 ** 58) for _ in range(2000)]
+        # Exact thresholds and their neighbours, where rounding would show.
+        for level in (2, 1000, 10 ** 6, 3 * 10 ** 8):
+            threshold = curve.threshold(level)
+            xps += [threshold - 1, threshold, threshold + 1]
+        xps += [0, -5]
+        assert curve.levels(xps) == [curve.level(xp) for xp in xps]
+
+    # Too big for int64 arithmetic, still exact.
+    huge = [2 ** 62, 2 ** 70, 5]
+    assert LevelCurve(1).levels(huge) == [LevelCurve(1).level(xp) for xp in huge]
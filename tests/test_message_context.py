@@ -0,0 +1,60 @@
+import asyncio
+import types
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot.utils.cogs.level import XPBuffer  # noqa: E402
+from bot.utils.message_context import MessageContextCache  # noqa: E402
+from tests.fake_api import FakeKatAPI  # noqa: E402
+
+
+def fake_message(message_id, guild_id=1, user_id=2):
+    guild = types.SimpleNamespace(id=guild_id) if guild_id else None
+    return types.SimpleNamespace(id=message_id, guild=guild, author=types.SimpleNamespace(id=user_id))
+
+
+def test_listeners_share_one_lookup_per_resource(run_against):
+    api = FakeKatAPI(latency=0.01)
+    api.seed_guild(1, members=3)
+
+    async def test(session):
+        bot = types.SimpleNamespace(session=session, get_guild=lambda guild_id: None)
+        contexts = MessageContextCache(max_size=2)
+        message = fake_message(10)
+
+        # Three listeners handling the same message at the same time.
+        listeners = [contexts.get(bot, message) for _ in range(3)]
+        assert listeners[0] is listeners[1] is listeners[2]
+        guilds = await asyncio.gather(*(c.guild() for c in listeners))
+        members = await asyncio.gather(*(c.member() for c in listeners))
+        assert guilds[0] is guilds[2] and members[0] is members[2]
+
+        dm = contexts.get(bot, fake_message(11, guild_id=None))
+        assert await dm.guild() is None and await dm.member() is None
+
+        contexts.get(bot, fake_message(12))
+        assert len(contexts) == 2
+
+    run_against(api, test)
+    assert api.request_count == 2
+
+
+def test_members_are_remembered_per_loader(run_against):
+    api = FakeKatAPI()
+    api.seed_guild(1, members=3)
+
+    async def test(session):
+        buffer = XPBuffer(session)
+        bot = types.SimpleNamespace(session=session, get_guild=lambda guild_id: None)
+        ctx = MessageContextCache().get(bot, fake_message(10))
+
+        plain = await ctx.member()
+        buffered = await ctx.member(buffer.get)
+        assert buffered is not plain
+        assert buffered is await buffer.get(1, 2)
+        # A fresh bound method of the same loader still shares the result.
+        assert await ctx.member(buffer.get) is buffered
+
+    run_against(api, test)
@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("psutil")
+
+from bot.utils.metrics import LatencyHistogram, RequestStats  # noqa: E402
+
+
+def test_observations_land_in_the_bucket_at_or_above_them():
+    histogram = LatencyHistogram()
+    for ms in (0, 5, 5.1, 10, 10000, 10001):
+        histogram.observe(ms)
+
+    buckets = dict(zip(LatencyHistogram.BUCKETS + ("over",), histogram.counts))
+    # Bounds are inclusive, anything past the last one goes in the overflow bucket.
+    assert buckets[5] == 2
+    assert buckets[10] == 2
+    assert buckets[10000] == 1
+    assert buckets["over"] == 1
+    assert histogram.count == 6
+    assert histogram.max == 10001
+
+
+def test_percentiles_report_the_bucket_upper_bound():
+    histogram = LatencyHistogram()
+    for _ in range(90):
+        histogram.observe(3)
+    for _ in range(9):
+        histogram.observe(40)
+    histogram.observe(700)
+
+    assert histogram.percentile(50) == 5.0
+    assert histogram.percentile(90) == 5.0
+    assert histogram.percentile(95) == 50.0
+    assert histogram.percentile(99) == 50.0
+    # Capped at the slowest seen rather than the 1000ms bound.
+    assert histogram.percentile(100) == 700.0
+    assert histogram.mean == pytest.approx((90 * 3 + 9 * 40 + 700) / 100)
+
+
+def test_percentile_past_the_last_bucket_is_the_max():
+    histogram = LatencyHistogram()
+    histogram.observe(20000)
+    assert histogram.percentile(50) == 20000
+
+
+def test_empty_histogram():
+    histogram = LatencyHistogram()
+    assert (histogram.mean, histogram.percentile(99)) == (0.0, 0.0)
+
+
+def test_request_stats_to_dict():
+    stats = RequestStats()
+    stats.record(20, nbytes=100)
+    stats.record(200, nbytes=50, error=True)
+
+    result = stats.to_dict()
+    assert (result["requests"], result["errors"], result["bytes"]) == (2, 1, 150)
+    assert (result["p50_ms"], result["p99_ms"], result["max_ms"]) == (25.0, 200.0, 200)
@@ -0,0 +1,281 @@
+import asyncio
+import datetime
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot.utils import models  # noqa: E402
+from bot.utils.codec import copy as codec_copy  # noqa: E402
+from bot.utils.models import (  # noqa: E402
+    Guild,
+    GuildCache,
+    Member,
+    User,
+    guild_cache,
+    partial_settings,
+)
+from bot.utils.persistence import PersistentStore  # noqa: E402
+from tests.fake_api import FakeKatAPI  # noqa: E402
+
+
+def test_guild_cache_expires_entries_after_ttl(clock):
+    cache = GuildCache(ttl=60, max_size=10)
+    cache.set(1, {"id": 1})
+
+    clock.now += 59
+    assert cache.get(1) == {"id": 1}
+    assert cache.is_fresh(1)
+
+    clock.now += 2
+    assert cache.get(1) is None
+    assert not cache.is_fresh(1)
+    # Expired entries are still there for when the API is down.
+    assert cache.get(1, allow_stale=True) == {"id": 1}
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_guild_cache_evicts_least_recently_used(clock):
+    cache = GuildCache(ttl=60, max_size=2)
+    cache.set(1, {"id": 1})
+    cache.set(2, {"id": 2})
+    cache.get(1)  # 2 is now the least recently used.
+    cache.set(3, {"id": 3})
+
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    assert len(cache) == 2
+    stats = cache.stats()
+    assert (stats["size"], stats["evictions"]) == (2, 1)
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (3, 1, 0.75)
+
+
+def test_guild_cache_hands_out_copies():
+    cache = GuildCache(ttl=60, max_size=10)
+    data = {"id": 1, "settings": {"settings": {"prefix": "$"}}}
+    cache.set(1, data)
+    data["settings"]["settings"]["prefix"] = "?"
+
+    first = cache.get(1)
+    first["settings"]["settings"]["prefix"] = "!"
+    assert cache.get(1)["settings"]["settings"]["prefix"] == "$"
+
+
+class RecordingSession:
+    """Stands in for `APIClient`, records PATCHes and what the cache held during them."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.patches = []
+
+    async def patch(self, endpoint, data, priority=None):
+        self.patches.append((endpoint, data, guild_cache.get(1)))
+        if self.fail:
+            raise models.ResponseStatusCodeException(503, None)
+        return data
+
+
+def test_guild_save_invalidates_then_writes_through():
+    guild_cache.clear()
+    guild_cache.set(1, {"id": 1, "settings": {"settings": {"prefix": "$"}}})
+    guild = Guild.from_dict(guild_cache.get(1))
+    guild.prefix = "!"
+
+    session = RecordingSession()
+    asyncio.run(guild.save(session))
+
+    (_, _, cached_during_patch), = session.patches
+    assert cached_during_patch is None
+    assert guild_cache.get(1)["settings"]["settings"]["prefix"] == "!"
+    guild_cache.clear()
+
+
+def test_guild_get_reads_through_the_cache(run_against):
+    api = FakeKatAPI()
+    api.seed_guild(1)
+
+    async def test(session):
+        await Guild.get(1, session)
+        await Guild.get(1, session)
+        return api.request_count
+
+    assert run_against(api, test) == 1
+
+
+SETTINGS = {
+    "settings": {
+        "prefix": "$",
+        "level": {"freeze": False, "curve": 40},
+        "fun": {"gorl": True},
+    }
+}
+
+
+def test_partial_settings_keeps_only_dirty_paths():
+    assert partial_settings(SETTINGS, {"settings.prefix", "settings.level.curve"}) == {
+        "settings": {"prefix": "$", "level": {"curve": 40}}
+    }
+    # The parent's value already includes its children.
+    assert partial_settings(SETTINGS, {"settings.level.freeze", "settings.level"}) == {
+        "settings": {"level": {"freeze": False, "curve": 40}}
+    }
+    assert partial_settings(SETTINGS, {"*", "settings.prefix"}) is SETTINGS
+    assert partial_settings(SETTINGS, {"settings.missing"}) == {"settings": {"missing": None}}
+    assert partial_settings(SETTINGS, set()) == {}
+
+
+def test_guild_to_patch_sends_changed_settings():
+    guild = Guild(1, codec_copy(SETTINGS))
+    assert guild.to_patch() == {"id": 1, "settings": {}}
+    guild.prefix = "!"
+    guild.set_setting("settings.level.freeze", True)
+    assert guild.to_patch() == {
+        "id": 1,
+        "settings": {"settings": {"prefix": "!", "level": {"freeze": True}}},
+    }
+    guild.settings = {"settings": {}}
+    assert guild.to_patch()["settings"] == {"settings": {}}
+
+
+def test_member_to_patch_sends_changed_fields():
+    member = Member.from_dict({"gid": 1, "id": 2, "xp": 5, "level": 1, "settings": {}})
+    member.xp = 5  # Unchanged values aren't dirty.
+    assert not member.is_dirty
+
+    member.xp = 50
+    member.set_setting("birthday.notify", True)
+    assert member.to_patch() == {
+        "id": 2,
+        "gid": 1,
+        "xp": 50,
+        "settings": {"birthday": {"notify": True}},
+    }
+    member.lvl = 2
+    member.settings = {"replaced": True}
+    assert member.to_patch() == {
+        "id": 2,
+        "gid": 1,
+        "xp": 50,
+        "level": 2,
+        "settings": {"replaced": True},
+    }
+
+
+def test_saving_without_changes_sends_nothing(run_against):
+    api = FakeKatAPI()
+    api.seed_guild(1, members=1)
+
+    async def test(session):
+        guild = await Guild.get(1, session)
+        member = await Member.get(1, 1, session)
+        requests = api.request_count
+        await guild.save(session)
+        await member.save(session)
+        return api.request_count - requests
+
+    assert run_against(api, test) == 0
+
+
+def test_failed_save_keeps_changes_dirty():
+    guild_cache.clear()
+    guild = Guild(1, codec_copy(SETTINGS))
+    guild.prefix = "!"
+    member = Member.from_dict({"gid": 1, "id": 2, "xp": 5, "level": 1})
+    member.xp = 10
+
+    session = RecordingSession(fail=True)
+    for model in (guild, member):
+        with pytest.raises(models.ResponseStatusCodeException):
+            asyncio.run(model.save(session))
+        assert model.is_dirty
+
+    session.fail = False
+    asyncio.run(guild.save(session))
+    asyncio.run(member.save(session))
+    assert [data for _, data, _ in session.patches[2:]] == [
+        {"id": 1, "settings": {"settings": {"prefix": "!"}}},
+        {"id": 2, "gid": 1, "xp": 10},
+    ]
+    assert not guild.is_dirty and not member.is_dirty
+    guild_cache.clear()
+
+
+def test_user_round_trips_without_parsing_the_birthday():
+    data = {"id": 1, "birthday": "2000-02-29", "years": 3}
+    user = User.from_dict(data)
+
+    assert user.to_json() == data
+    assert user._birthday is models._UNPARSED
+
+
+def test_user_birthday_is_parsed_on_first_read():
+    user = User.from_dict({"id": 1, "birthday": "2000-02-29", "years": 3})
+
+    assert user.birthday == datetime.datetime(2000, 2, 29)
+    assert user.birthday is user.birthday
+    assert user.to_json() == {"id": 1, "birthday": "2000-02-29", "years": 3}
+
+    user.birthday = datetime.datetime(1999, 12, 31)
+    assert user.to_json()["birthday"] == "1999-12-31"
+
+
+@pytest.mark.parametrize("data", [{"id": 1}, {"id": 1, "birthday": "None", "years": 0}])
+def test_user_without_a_birthday(data):
+    user = User.from_dict(data)
+
+    assert user.to_json() == {"id": 1, "birthday": None, "years": 0}
+    assert user.birthday is None
+    assert user.to_json() == {"id": 1, "birthday": None, "years": 0}
+
+
+def test_prefetch_fills_the_cache_within_its_concurrency(run_against):
+    api = FakeKatAPI(latency=0.05)
+    for guild_id in range(1, 9):
+        api.seed_guild(guild_id)
+
+    async def test(session):
+        guild_cache.set(1, {"id": 1})
+        first = await Guild.prefetch(range(1, 9), session, concurrency=3)
+        requests = api.request_count
+        again = await Guild.prefetch(range(1, 9), session, concurrency=3)
+        return first, requests, again, [guild_cache.is_fresh(i) for i in range(1, 9)]
+
+    first, requests, again, fresh = run_against(api, test)
+    # Guild 1 was already cached, so only the other 7 are fetched, 3 at a time.
+    assert first == (7, 0)
+    assert requests == 7
+    assert api.max_in_flight == 3
+    assert again == (0, 0)
+    assert all(fresh)
+
+
+def test_prefetch_counts_failures(run_against):
+    api = FakeKatAPI(error_rate=1.0, error_status=404)
+
+    async def test(session):
+        return await Guild.prefetch([1, 2], session)
+
+    assert run_against(api, test) == (0, 2)
+    assert len(guild_cache) == 0
+
+
+def test_warm_start_seeds_the_cache_from_persisted_documents(run_against, tmp_path):
+    api = FakeKatAPI()
+    api.seed_guild(1, settings={"settings": {"prefix": "!"}})
+    api.seed_guild(2)
+
+    async def test(session):
+        session.store = PersistentStore(str(tmp_path / "api_cache.sqlite"))
+        await session.get("guilds/1")
+        guild_cache.clear()
+
+        seeded = Guild.warm_start([1, 2], session)
+        requests = api.request_count
+        guild = await Guild.get(1, session)
+        session.store.close()
+        return seeded, requests, guild.prefix
+
+    seeded, requests, prefix = run_against(api, test)
+    assert seeded == 1
+    # Served from the seeded cache, not fetched again.
+    assert (requests, api.request_count, prefix) == (1, 1, "!")
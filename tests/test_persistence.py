@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from bot.utils.api import APIClient, CircuitBreaker  # noqa: E402
+from bot.utils.models import Guild, guild_cache  # noqa: E402
+from bot.utils.persistence import PersistentStore  # noqa: E402
+from tests.fake_api import FakeKatAPI  # noqa: E402
+
+
+@pytest.fixture
+def persisted(tmp_path, monkeypatch):
+    """Give each `APIClient` a fresh store, a breaker that stays closed and no backoff."""
+    monkeypatch.setattr(APIClient, "_backoff", staticmethod(lambda attempt: 0))
+    monkeypatch.setattr(
+        APIClient, "breaker", lambda self, endpoint: CircuitBreaker(1000, 0)
+    )
+    return lambda: PersistentStore(str(tmp_path / "api_cache.sqlite"))
+
+
+def test_outage_serves_stale_reads_and_replays_writes_in_order(run_against, persisted):
+    api = FakeKatAPI()
+    api.seed_guild(1, members=2)
+
+    async def test(session):
+        session.store = persisted()
+        await session.get("guilds/1/1")
+
+        await api.stop()
+        await session.patch("guilds/1/1", {"xp": 1})
+        # The API rejects this one outright when it comes back.
+        session.store.queue_write("PATCH", "missing/1", {})
+        await session.patch("guilds/1/2", {"xp": 2})
+        stale = await session.get("guilds/1/1")
+        assert session.store.pending == 3
+        assert api.writes == []
+
+        await api.start(port=api.port)
+        # Writes alone are enough to restart a replay that stopped on an error.
+        await session.patch("guilds/1/1", {"xp": 3})
+        await session._replay_task
+        return stale, session.store.pending
+
+    stale, pending = run_against(api, test)
+    assert stale[0]["xp"] == 1
+    assert pending == 0
+    assert api.writes == [
+        ("PATCH", "/guilds/1/1", {"xp": 1}),
+        ("PATCH", "/missing/1", {}),
+        ("PATCH", "/guilds/1/2", {"xp": 2}),
+        ("PATCH", "/guilds/1/1", {"xp": 3}),
+    ]
+    assert api.members[(1, 1)]["xp"] == 3
+
+
+def test_queued_writes_survive_a_restart(run_against, persisted):
+    api = FakeKatAPI()
+    api.seed_guild(1, members=1)
+
+    async def test(session):
+        session.store = persisted()
+        await api.stop()
+        await session.patch("guilds/1", {"settings": {"settings": {"prefix": "!"}}})
+        session.store.close()
+
+        await api.start(port=api.port)
+        session.store = persisted()
+        assert session.store.pending == 1
+        # The API still has "$" until the write is replayed, the queued write wins.
+        during = await Guild.get(1, session)
+        assert during.prefix == "!"
+        await session._replay_task
+        assert guild_cache.get(1) is None  # Dropped once the write landed.
+        after = await Guild.get(1, session)
+        stored = session.store.get("guilds/1")[0]["settings"]["settings"]["prefix"]
+        return session.store.pending, after.prefix, stored
+
+    assert run_against(api, test) == (0, "!", "!")
+    assert api.guilds[1]["settings"]["settings"]["prefix"] == "!"
+
+
+def test_outage_without_a_stored_copy_still_raises(run_against, persisted):
+    api = FakeKatAPI()
+
+    async def test(session):
+        session.store = persisted()
+        await api.stop()
+        with pytest.raises(Exception) as e:
+            await session.get("guilds/1")
+        return e.value.code
+
+    assert run_against(api, test) == 503